@@ -0,0 +1,335 @@
+import numpy as np
+
+import strength
+from network import MAX_ITERATIONS
+
+
+def read_arrays(filename, metric='strength'):
+    # Read a parsed graph into arrays: node ids, probabilities and a CSR
+    # adjacency (indptr, indices, strength) over node indices 0..n-1, with
+    # the strength taken from the given metric attribute. Nodes are indexed,
+    # and each node's neighbors ordered, as in the graph built by
+    # network.read_graph, so the array engine samples from pools in the same
+    # order as graph_test. A metric the file does not store is computed from
+    # the adjacency.
+    strength.check_metrics([metric])
+    stored = True
+    nodes = []
+    probability = []
+    sources = []
+    targets = []
+    strengths = []
+
+    with open(filename, 'r') as file:
+        for line in file:
+            fields = line.split(' ')
+            if fields[1] == 'probability':
+                nodes.append(int(fields[0]))
+                probability.append(float(fields[2].strip()))
+            else:
+                sources.append(int(fields[0]))
+                targets.append(int(fields[1]))
+                if metric == 'strength':
+                    # Parsed exactly as read_graph does (including dropping
+                    # the last digit) so both engines see identical strengths
+                    strengths.append(float(fields[3].strip()[:-2]))
+                elif stored and '\'' + metric + '\': ' in line:
+                    value = line.split('\'' + metric + '\': ')[1]
+                    strengths.append(float(value.split(',')[0].split('}')[0]))
+                else:
+                    stored = False
+
+    index = {node: i for i, node in enumerate(nodes)}
+    n = len(nodes)
+    sources = np.array([index[node] for node in sources], dtype=np.int64)
+    targets = np.array([index[node] for node in targets], dtype=np.int64)
+    strengths = np.array(strengths)
+
+    # Each edge appears in the adjacency of both endpoints. A stable sort by
+    # source keeps neighbors in the order the edges were read.
+    rows = np.column_stack([sources, targets]).ravel()
+    cols = np.column_stack([targets, sources]).ravel()
+    order = np.argsort(rows, kind='stable')
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(rows, minlength=n))])
+    if stored:
+        strengths = np.repeat(strengths, 2)[order]
+    else:
+        strengths = strength.csr_metric(indptr, cols[order], metric)
+
+    return {
+        'nodes': np.array(nodes),
+        'probability': np.array(probability),
+        'indptr': indptr,
+        'indices': cols[order],
+        'strength': strengths
+    }
+
+
+def split_neighbors(graph, threshold):
+    # Reorder each node's neighbors so strong neighbors (strength over the
+    # threshold) come first, keeping their relative order. Returns the
+    # reordered indices and, per node, the end of its strong neighbors.
+    indptr = graph['indptr']
+    n = len(indptr) - 1
+    rows = np.repeat(np.arange(n), np.diff(indptr))
+    weak = graph['strength'] <= threshold
+    order = np.argsort(rows * 2 + weak, kind='stable')
+    n_strong = np.bincount(rows[~weak], minlength=n)
+
+    return graph['indices'][order], indptr[:-1] + n_strong
+
+
+def new_bits(rows, n):
+    # Bit-packed flags, one row of n bits per campaign
+    return np.zeros((rows, (n + 7) // 8), dtype=np.uint8)
+
+
+def get_bits(bits, idx):
+    # Flags of the nodes idx in a row of packed bits
+    return (bits[idx >> 3] >> (7 - (idx & 7))) & 1
+
+
+def set_bits(bits, idx):
+    # Set the flags of the nodes idx in a row of packed bits
+    np.bitwise_or.at(bits, idx >> 3,
+                     (1 << (7 - (idx & 7))).astype(np.uint8))
+
+
+def equal_shares(wants, slots, weights):
+    # Split the slots evenly, passing any share a campaign cannot use on to
+    # the others
+    shares = [0] * len(wants)
+    remaining = slots
+    open_campaigns = list(range(len(wants)))
+    while remaining > 0 and open_campaigns:
+        share, extra = divmod(remaining, len(open_campaigns))
+        for rank, c in enumerate(list(open_campaigns)):
+            give = min(wants[c] - shares[c], share + (rank < extra))
+            shares[c] += give
+            remaining -= give
+            if shares[c] == wants[c]:
+                open_campaigns.remove(c)
+
+    return shares
+
+
+def priority_shares(wants, slots, weights):
+    # Campaigns take their full composition in campaign order until the
+    # slots run out
+    shares = []
+    for want in wants:
+        shares.append(min(want, slots))
+        slots -= shares[-1]
+
+    return shares
+
+
+def proportional_shares(wants, slots, weights):
+    # Split the slots in proportion to the campaign weights (e.g. bids),
+    # passing any share a campaign cannot use on to the others in proportion
+    # to their weights
+    wants = np.array(wants)
+    weights = np.array(weights, dtype=np.float64)
+    shares = np.zeros(len(wants), dtype=int)
+    remaining = slots
+    open_campaigns = np.flatnonzero(wants > 0)
+    while remaining > 0 and len(open_campaigns):
+        weight = weights[open_campaigns]
+        if weight.sum() <= 0:
+            weight = np.ones(len(open_campaigns))
+        quota = remaining * weight / weight.sum()
+        room = wants[open_campaigns] - shares[open_campaigns]
+        give = np.minimum(np.floor(quota).astype(int), room)
+
+        # Hand out what is left by largest remaining quota
+        for i in np.argsort(give - quota, kind='stable'):
+            if give.sum() >= remaining:
+                break
+            if give[i] < room[i]:
+                give[i] += 1
+
+        shares[open_campaigns] += give
+        remaining -= give.sum()
+        open_campaigns = open_campaigns[give < room]
+
+    return shares.tolist()
+
+
+# Policies for sharing a node's newsfeed slots between the campaigns it
+# clicked. Each takes the slots wanted by each campaign, the slots available
+# and the campaign weights, and returns the slots given to each campaign.
+SLOT_POLICIES = {
+    'equal': equal_shares,
+    'priority': priority_shares,
+    'proportional': proportional_shares
+}
+
+
+def fill_slots(rs, composition, strong_nbrs, weak_nbrs, random_pool):
+    # Choose the nodes shown an ad by one clicked node, following the
+    # Ad-Serve composition exactly as graph_test does (including the order of
+    # random draws). random_pool is called only if random nodes are needed.
+    to_show = []
+    leftovers = 0
+
+    if composition[0] < len(strong_nbrs):
+        chosen = rs.choice(strong_nbrs, size=composition[0], replace=False)
+        to_show.append(chosen)
+        strong_remain = strong_nbrs[~np.isin(strong_nbrs, chosen)]
+    else:
+        to_show.append(strong_nbrs)
+        strong_remain = strong_nbrs[:0]
+        leftovers += composition[0] - len(strong_nbrs)
+
+    if composition[1] < len(weak_nbrs):
+        chosen = rs.choice(weak_nbrs, size=composition[1], replace=False)
+        to_show.append(chosen)
+        weak_remain = weak_nbrs[~np.isin(weak_nbrs, chosen)]
+    else:
+        to_show.append(weak_nbrs)
+        weak_remain = weak_nbrs[:0]
+        leftovers += composition[1] - len(weak_nbrs)
+
+    # Fill with strong neighbors
+    if leftovers > 0 and leftovers > len(strong_remain):
+        to_show.append(strong_remain)
+        leftovers -= len(strong_remain)
+    elif leftovers > 0:
+        to_show.append(rs.choice(strong_remain, size=leftovers,
+                                 replace=False))
+        leftovers = 0
+
+    # Fill with weak neighbors
+    if leftovers > 0 and leftovers > len(weak_remain):
+        to_show.append(weak_remain)
+        leftovers -= len(weak_remain)
+    elif leftovers > 0:
+        to_show.append(rs.choice(weak_remain, size=leftovers, replace=False))
+        leftovers = 0
+
+    # Fill with random nodes
+    if leftovers > 0:
+        random_nbrs = random_pool()
+        if leftovers > len(random_nbrs):
+            to_show.append(random_nbrs)
+        else:
+            to_show.append(rs.choice(random_nbrs, size=leftovers,
+                                     replace=False))
+
+    return np.concatenate(to_show).astype(np.int64)
+
+
+def run_campaigns(graph, compositions, items, threshold, limit, slots=None,
+                  policy='equal', weights=None, seed=None):
+    # Advance several campaigns over the same graph in one pass. Each
+    # campaign has its own Ad-Serve composition, number of starting items and
+    # seen / clicked state (held as bit-packed rows). A node that clicked
+    # several campaigns shares its newsfeed slots between them by the given
+    # policy; with slots None every campaign gets its full composition. With
+    # a single campaign this reproduces graph_test, draw for draw when using
+    # the same random stream. Returns (iteration, clicked, seen, condition)
+    # per campaign. As in graph_test, the probability increase from
+    # increase_prob is not applied (graph_test stores it under a misspelt
+    # attribute).
+    rs = np.random if seed is None else np.random.RandomState(seed)
+    n = len(graph['probability'])
+    n_campaigns = len(compositions)
+    indices, split = split_neighbors(graph, threshold)
+    indptr = graph['indptr']
+    probability = graph['probability']
+    if weights is None:
+        weights = [1] * n_campaigns
+    share_slots = SLOT_POLICIES[policy]
+
+    seen = new_bits(n_campaigns, n)
+    clicked = new_bits(n_campaigns, n)
+    ranked = np.argsort(-probability, kind='stable')
+
+    frontier = []
+    seen_count = []
+    clicked_count = []
+    for c in range(n_campaigns):
+        generators = np.sort(ranked[:items[c]])
+        set_bits(seen[c], generators)
+        set_bits(clicked[c], generators)
+        frontier.append(generators)
+        seen_count.append(len(generators))
+        clicked_count.append(len(generators))
+
+    results = [None] * n_campaigns
+    iteration = 0
+
+    while any(result is None for result in results):
+        active = [c for c in range(n_campaigns) if results[c] is None]
+        shown = [[] for c in range(n_campaigns)]
+
+        # Clicked nodes in node order, with the campaigns each one clicked
+        clickers = {}
+        for c in active:
+            for node in frontier[c].tolist():
+                clickers.setdefault(node, []).append(c)
+
+        for node in sorted(clickers):
+            campaigns = clickers[node]
+            strong_all = indices[indptr[node]:split[node]]
+            weak_all = indices[split[node]:indptr[node + 1]]
+            nbrs = indices[indptr[node]:indptr[node + 1]]
+
+            if slots is None:
+                allocation = [compositions[c] for c in campaigns]
+            else:
+                wants = [sum(compositions[c]) for c in campaigns]
+                shares = share_slots(wants, slots,
+                                     [weights[c] for c in campaigns])
+                allocation = []
+                for c, share, want in zip(campaigns, shares, wants):
+                    # A campaign that wants no slots gets none
+                    if want == 0:
+                        allocation.append([0, 0])
+                        continue
+                    strong = int(round(compositions[c][0] * share / want))
+                    allocation.append([strong, share - strong])
+
+            for c, composition in zip(campaigns, allocation):
+                strong_nbrs = strong_all[get_bits(seen[c], strong_all) == 0]
+                weak_nbrs = weak_all[get_bits(seen[c], weak_all) == 0]
+
+                def random_pool():
+                    unseen = np.unpackbits(seen[c])[:n] == 0
+                    unseen[nbrs] = False
+                    return np.flatnonzero(unseen)
+
+                to_show = fill_slots(rs, composition, strong_nbrs, weak_nbrs,
+                                     random_pool)
+                set_bits(seen[c], to_show)
+                seen_count[c] += len(to_show)
+                shown[c].append(to_show)
+
+        # Test the nodes shown each campaign, in node order, for clicks
+        for c in active:
+            if shown[c]:
+                tested = np.sort(np.concatenate(shown[c]))
+            else:
+                tested = np.zeros(0, dtype=np.int64)
+            clicks = tested[rs.random_sample(len(tested)) <
+                            probability[tested]]
+            set_bits(clicked[c], clicks)
+            frontier[c] = clicks
+
+            # Check the stopping criteria of each campaign
+            clicked_prev = clicked_count[c]
+            clicked_count[c] += len(clicks)
+            if seen_count[c] >= limit:
+                condition = 'views upper limit'
+            elif clicked_count[c] == clicked_prev:
+                condition = 'no progress'
+            elif iteration >= MAX_ITERATIONS:
+                condition = 'iteration upper limit'
+            else:
+                continue
+            results[c] = (iteration + 1, clicked_count[c], seen_count[c],
+                          condition)
+
+        iteration += 1
+
+    return results
@@ -0,0 +1,251 @@
+import os
+import sys
+from array import array
+
+import numpy as np
+
+import cascade
+from network import read_graph, clicks_per_view
+
+
+# Quantized strengths are stored as integers in [0, scale]
+STRENGTH_TYPES = {8: np.uint8, 16: np.uint16}
+
+# Arrays of a compact graph, as saved by save_compact
+COMPACT_ARRAYS = ['nodes', 'probability', 'indptr', 'indices', 'strength']
+
+
+def quantize(values, bits=8):
+    # Quantize values in [0, 1] (strengths, or a threshold) to the nearest of
+    # 2 ** bits evenly spaced levels
+    scale = 2 ** bits - 1
+    return np.round(np.asarray(values) * scale).astype(STRENGTH_TYPES[bits])
+
+
+def dequantize(levels, bits=8):
+    # Strengths represented by quantized levels
+    return levels / (2 ** bits - 1)
+
+
+def compact_arrays(graph, bits=8):
+    # Compact copy of a graph read by cascade.read_arrays: int32 CSR,
+    # quantized strengths and float32 probabilities. Neighbors keep their
+    # order, so the array engine makes the same draws on either copy.
+    return {
+        'nodes': graph['nodes'].astype(np.int32),
+        'probability': graph['probability'].astype(np.float32),
+        'indptr': graph['indptr'].astype(np.int32),
+        'indices': graph['indices'].astype(np.int32),
+        'strength': quantize(graph['strength'], bits),
+        'bits': bits
+    }
+
+
+def read_compact(filename, bits=8):
+    # Read a parsed graph straight into the compact representation, without
+    # holding a Python object per edge. Equivalent to
+    # compact_arrays(cascade.read_arrays(filename), bits).
+    nodes = array('l')
+    probability = array('f')
+    ends = array('l')
+    strengths = array('d')
+
+    with open(filename, 'r') as file:
+        for line in file:
+            fields = line.split(' ')
+            if fields[1] == 'probability':
+                nodes.append(int(fields[0]))
+                probability.append(float(fields[2].strip()))
+            else:
+                ends.append(int(fields[0]))
+                ends.append(int(fields[1]))
+                # Parsed exactly as read_graph does
+                strengths.append(float(fields[3].strip()[:-2]))
+
+    nodes = np.frombuffer(nodes, dtype=np.dtype('l')).astype(np.int32)
+    n = len(nodes)
+    index = np.zeros(nodes.max() + 1, dtype=np.int32)
+    index[nodes] = np.arange(n, dtype=np.int32)
+
+    # Edge ends are already interleaved (source, target) per edge, which is
+    # the order read_arrays sorts into
+    rows = index[np.frombuffer(ends, dtype=np.dtype('l'))]
+    del ends
+    cols = rows.reshape(-1, 2)[:, ::-1].ravel()
+    order = np.argsort(rows, kind='stable')
+    levels = np.repeat(quantize(np.frombuffer(strengths), bits), 2)
+
+    indptr = np.zeros(n + 1, dtype=np.int32)
+    np.cumsum(np.bincount(rows, minlength=n), out=indptr[1:])
+
+    return {
+        'nodes': nodes,
+        'probability': np.frombuffer(probability, dtype=np.float32).copy(),
+        'indptr': indptr,
+        'indices': cols[order],
+        'strength': levels[order],
+        'bits': bits
+    }
+
+
+def compact_threshold(compact, threshold):
+    # Strong / weak threshold in quantized levels. Strengths and threshold
+    # are quantized the same way, so the strong / weak split only changes
+    # for strengths that round to the same level as the threshold.
+    return int(quantize(threshold, compact['bits']))
+
+
+def save_compact(compact, directory):
+    # Save a compact graph as one .npy file per array, so that load_compact
+    # can memory map it and workers on one machine share a single copy
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    for key in COMPACT_ARRAYS:
+        np.save(os.path.join(directory, key + '.npy'), compact[key])
+    np.save(os.path.join(directory, 'bits.npy'), np.array(compact['bits']))
+
+
+def load_compact(directory, mmap=True):
+    # Load a compact graph saved by save_compact, read only and memory mapped
+    # by default
+    mode = 'r' if mmap else None
+    compact = {key: np.load(os.path.join(directory, key + '.npy'),
+                            mmap_mode=mode)
+               for key in COMPACT_ARRAYS}
+    compact['bits'] = int(np.load(os.path.join(directory, 'bits.npy')))
+
+    return compact
+
+
+def deep_size(obj, seen=None):
+    # Bytes held by an object and everything it refers to through dicts,
+    # lists, tuples and sets, counting shared objects once
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            size += deep_size(key, seen) + deep_size(value, seen)
+    elif isinstance(obj, (list, tuple, set)):
+        for item in obj:
+            size += deep_size(item, seen)
+
+    return size
+
+
+def array_sizes(graph):
+    # Bytes of each array of a graph held as arrays
+    return {key: int(graph[key].nbytes) for key in COMPACT_ARRAYS}
+
+
+def memory_report(filename, bits=8, campaigns=1, include_networkx=True):
+    # Memory used by each structure of a parsed graph in the NetworkX graph
+    # of read_graph, the arrays of cascade.read_arrays and the compact
+    # representation, along with the seen / clicked state of the given
+    # number of concurrent campaigns. Sizes are in bytes.
+    graph = cascade.read_arrays(filename)
+    compact = compact_arrays(graph, bits)
+    n = len(graph['nodes'])
+    n_edges = len(graph['indices']) // 2
+
+    report = {'nodes': n, 'edges': n_edges}
+    if include_networkx:
+        G = read_graph(filename)
+        # Node attributes include the seen / clicked flags of one campaign
+        report['networkx'] = {
+            'node_attributes': deep_size(G.node),
+            'adjacency': deep_size(G.adj),
+            'state': 0
+        }
+        del G
+
+    # Two boolean arrays (seen, clicked) per campaign for the plain arrays,
+    # two bit-packed rows per campaign for the compact representation
+    report['arrays'] = array_sizes(graph)
+    report['arrays']['state'] = 2 * campaigns * n
+    report['compact'] = array_sizes(compact)
+    report['compact']['state'] = int(2 * cascade.new_bits(campaigns,
+                                                          n).nbytes)
+
+    for key in ['networkx', 'arrays', 'compact']:
+        if key in report:
+            report[key]['total'] = sum(report[key].values())
+            report[key]['per_edge'] = report[key]['total'] / n_edges
+
+    return report
+
+
+def quantization_error(filename, compositions, items, threshold, limit,
+                       bits=8, n_runs=100, seed=123):
+    # Effect of the compact representation on simulation outputs. Reports the
+    # strength and probability rounding errors, the edges whose strong / weak
+    # class changes, and for each composition the sampled outputs on both
+    # representations. Each replicate runs on both with its own random
+    # stream, so a pair of runs only differs where quantization changed a
+    # neighbor pool or a click.
+    graph = cascade.read_arrays(filename)
+    compact = compact_arrays(graph, bits)
+    level = compact_threshold(compact, threshold)
+
+    strong = graph['strength'] > threshold
+    flipped = strong != (compact['strength'] > level)
+    report = {
+        'bits': bits,
+        'strength_error': float(np.max(np.abs(
+            dequantize(compact['strength'], bits) - graph['strength']))),
+        'probability_error': float(np.max(np.abs(
+            compact['probability'] - graph['probability']))),
+        'flipped_edges': int(flipped.sum()) // 2,
+        'strong_edges': int(strong.sum()) // 2,
+        'compositions': []
+    }
+
+    for composition in compositions:
+        runs = {'full': [], 'compact': []}
+        for replicate in range(n_runs):
+            runs['full'] += cascade.run_campaigns(
+                graph, [composition], [items], threshold, limit,
+                seed=seed + replicate)
+            runs['compact'] += cascade.run_campaigns(
+                compact, [composition], [items], level, limit,
+                seed=seed + replicate)
+
+        outputs = {'composition': composition,
+                   'identical_runs': sum(a == b for a, b in
+                                         zip(runs['full'], runs['compact']))}
+        for key in ['full', 'compact']:
+            clicks = np.mean([run[1] for run in runs[key]])
+            views = np.mean([run[2] for run in runs[key]])
+            outputs[key] = {
+                'iterations': np.mean([run[0] for run in runs[key]]),
+                'clicks': clicks, 'views': views,
+                'cpv': clicks_per_view(items, clicks, views)
+            }
+        report['compositions'].append(outputs)
+
+    return report
+
+
+def main():
+    filename = './simulation_networks/fb_parsed_influencers.edgelist'
+
+    for key, value in memory_report(filename).items():
+        print(key + ': ' + str(value))
+
+    for bits in STRENGTH_TYPES:
+        report = quantization_error(filename, [[40, 0], [20, 20], [10, 0]],
+                                    10, 0.5, 4000, bits)
+        for key, value in report.items():
+            if key == 'compositions':
+                for outputs in value:
+                    print(outputs)
+            else:
+                print(key + ': ' + str(value))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+import sys
+from array import array
+
+import numpy as np
+
+
+def read_edges(filename):
+    # Read an edge list (facebook_combined.txt, a NetworkX edgelist or a
+    # parsed graph) into an (E, 2) integer array, without building a graph.
+    # Comment lines and probability lines of parsed graphs are skipped.
+    edges = array('q')
+    with open(filename, 'r') as file:
+        for line in file:
+            if line[0] == '#':
+                continue
+            fields = line.split(None, 2)
+            if len(fields) < 2 or fields[1] == 'probability':
+                continue
+            edges.append(int(fields[0]))
+            edges.append(int(fields[1]))
+
+    return np.frombuffer(edges, dtype=np.int64).reshape(-1, 2)
+
+
+def relabel(edges):
+    # Map arbitrary node ids onto 0..n-1. Returns the relabelled edges and the
+    # original id of each new label.
+    nodes, inverse = np.unique(edges, return_inverse=True)
+    return inverse.reshape(edges.shape), nodes
+
+
+def degrees(edges, n=None):
+    # Degree of every node of an undirected edge array with labels 0..n-1
+    return np.bincount(edges.ravel(), minlength=0 if n is None else n)
+
+
+def degree_histogram(deg):
+    # Number of nodes with each degree, indexed by degree
+    return np.bincount(deg)
+
+
+def ccdf(deg):
+    # Complementary cumulative distribution P(K >= k) at each distinct degree
+    values, counts = np.unique(deg, return_counts=True)
+    tail = np.cumsum(counts[::-1])[::-1]
+    return values, tail / len(deg)
+
+
+def log_binned(deg, bins_per_decade=10):
+    # Degree density in logarithmically spaced bins. Returns the geometric
+    # centre of each non-empty bin and the fraction of nodes per unit degree.
+    deg = deg[deg > 0]
+    decades = np.log10(deg.max() + 1)
+    n_bins = max(int(np.ceil(decades * bins_per_decade)), 1)
+    edges = np.unique(np.floor(np.logspace(0, decades, n_bins + 1)))
+    edges[-1] = deg.max() + 1
+
+    counts = np.histogram(deg, bins=edges)[0]
+    widths = np.diff(edges)
+    centres = np.sqrt(edges[:-1] * (edges[1:] - 1))
+    keep = counts > 0
+
+    return centres[keep], counts[keep] / widths[keep] / len(deg)
+
+
+def power_law_fit(deg, k_min=None, min_tail=50):
+    # Fit a power law to the degree tail k >= k_min with the discrete maximum
+    # likelihood estimate of Clauset, Shalizi and Newman. If k_min is not
+    # given it is chosen to minimise the Kolmogorov-Smirnov distance between
+    # the fitted and observed tails of at least min_tail nodes, or is the
+    # smallest degree if no tail is that large. Returns None if no node has
+    # a positive degree.
+    values, counts = np.unique(deg[deg > 0], return_counts=True)
+    values = values.astype(np.float64)
+
+    # Tail sizes and tail sums of log(k) for every candidate k_min at once
+    tail_sizes = np.cumsum(counts[::-1])[::-1]
+    log_sums = np.cumsum((counts * np.log(values))[::-1])[::-1]
+    alphas = 1 + tail_sizes / (log_sums -
+                               tail_sizes * np.log(values - 0.5))
+
+    if k_min is not None:
+        candidates = np.flatnonzero(values >= k_min)[:1]
+    else:
+        candidates = np.flatnonzero(tail_sizes >= min_tail)
+        if len(candidates) == 0:
+            # Small graphs: fit the largest tail there is
+            candidates = np.arange(min(len(values), 1))
+
+    best = None
+    for i in candidates:
+        tail_ccdf = tail_sizes[i:] / tail_sizes[i]
+        model_ccdf = (values[i:] / values[i]) ** (1 - alphas[i])
+        ks = np.max(np.abs(tail_ccdf - model_ccdf))
+        if best is None or ks < best['ks']:
+            best = {'alpha': float(alphas[i]),
+                    'sigma': float((alphas[i] - 1) / np.sqrt(tail_sizes[i])),
+                    'k_min': int(values[i]), 'n_tail': int(tail_sizes[i]),
+                    'ks': float(ks)}
+
+    return best
+
+
+def pa_edges(n, m, seed=123):
+    # Generate a preferential attachment (Barabasi-Albert) graph directly as
+    # an edge array, using the same attachment process as
+    # nx.barabasi_albert_graph
+    rng = np.random.RandomState(seed)
+    edges = np.empty((m * (n - m), 2), dtype=np.int64)
+    repeated = np.empty(2 * m * (n - m), dtype=np.int64)
+    targets = list(range(m))
+    pos = 0
+
+    for source in range(m, n):
+        row = (source - m) * m
+        edges[row:row + m, 0] = source
+        edges[row:row + m, 1] = targets
+        repeated[pos:pos + m] = targets
+        repeated[pos + m:pos + 2 * m] = source
+        pos += 2 * m
+
+        # Choose m unique targets with probability proportional to degree
+        chosen = []
+        while len(chosen) < m:
+            draws = (rng.random_sample(m) * pos).astype(np.int64)
+            for target in repeated[draws].tolist():
+                if target not in chosen:
+                    chosen.append(target)
+                    if len(chosen) == m:
+                        break
+        targets = chosen
+
+    return edges
+
+
+def degree_summary(deg, fit=True):
+    # Summary statistics of a degree sequence
+    summary = {
+        'nodes': len(deg),
+        'edges': int(deg.sum()) // 2,
+        'mean_degree': float(deg.mean()),
+        'max_degree': int(deg.max()),
+        'median_degree': float(np.median(deg))
+    }
+    if fit:
+        summary['power_law'] = power_law_fit(deg)
+
+    return summary
+
+
+def graph_degrees(filename):
+    # Degree sequence of the graph stored in filename
+    return degrees(relabel(read_edges(filename))[0])
+
+
+def compare_degree_distributions(filenames):
+    # Degree summaries, CCDFs and log-binned distributions of each graph, for
+    # comparing the Facebook graph against generated graphs
+    comparison = {}
+    for filename in filenames:
+        deg = graph_degrees(filename)
+        comparison[filename] = {
+            'summary': degree_summary(deg),
+            'ccdf': ccdf(deg),
+            'log_binned': log_binned(deg)
+        }
+
+    return comparison
+
+
+def main():
+    filenames = sys.argv[1:] or [
+        'facebook_combined.txt',
+        './simulation_networks/pa_parsed_4039.edgelist'
+    ]
+
+    for filename, data in compare_degree_distributions(filenames).items():
+        print(filename)
+        for key, value in data['summary'].items():
+            print('\t' + key + ': ' + str(value))
+
+
+if __name__ == '__main__':
+    main()
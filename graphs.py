@@ -1,39 +1,89 @@
-import networkx as nx
 import matplotlib.pyplot as plt
 import numpy as np
 import os
 import ast
+import hashlib
+import pickle
+from multiprocessing import Pool
 from operator import itemgetter
 import seaborn as sns
 
+import degree_stats
 
-def distribution_plot():
-    F = nx.Graph()
 
-    # Create original network from facebook.txt
-    with open('facebook_combined.txt', 'r') as file:
-        for line in file:
-            if line[0] != '#':
-                F.add_edge(int(line.strip().split(' ')[0]),
-                           int(line.strip().split(' ')[1]),
-                           strength=0)
+# Directory derived datasets are cached in between batch runs
+CACHE_DIR = './figure_cache'
+
+# Output file of the number of influencers figure, in both batch and
+# interactive mode
+INFLUENCERS_FILE = './output_data/influencers_4_6.txt'
+
+# Graphs of the degree CCDF figure
+CCDF_FILES = ['facebook_combined.txt',
+              './simulation_networks/pa_parsed_4039.edgelist']
+
+
+def cached(name, inputs, func, *args):
+    # Return func(*args), reusing the result cached under name if none of the
+    # input files have changed since it was computed
+    key = hashlib.sha1()
+    key.update(repr(args).encode())
+    for path in sorted(inputs):
+        stat = os.stat(path)
+        key.update((path + str(stat.st_mtime_ns) + str(stat.st_size)).encode())
+    key = key.hexdigest()
+
+    cache_file = os.path.join(CACHE_DIR, name + '.pickle')
+    if os.path.exists(cache_file):
+        with open(cache_file, 'rb') as file:
+            cache_key, data = pickle.load(file)
+        if cache_key == key:
+            return data
+
+    data = func(*args)
+
+    # Write to a temporary file first so parallel renders never read a
+    # partially written cache
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with open(cache_file + '.' + str(os.getpid()), 'wb') as file:
+        pickle.dump((key, data), file)
+    os.replace(cache_file + '.' + str(os.getpid()), cache_file)
+
+    return data
+
+
+def finish_plot(filename=None):
+    # Show the current figure, or save it to filename when rendering
+    # headlessly
+    if filename is None:
+        plt.show()
+    else:
+        plt.savefig(filename, bbox_inches='tight')
+        plt.close('all')
 
-    probs = []
-    random_probs = []
-    max_degree = 0
-    for node in F.nodes():
-        if F.degree(node) > max_degree:
-            max_degree = F.degree(node)
 
-    for node in F.nodes():
-        probs.append(F.degree(node) / max_degree * 0.7)
+def output_files(directory, prefix):
+    # List the output files in directory whose names start with prefix
+    return sorted(file for file in os.listdir(directory)
+                  if file.startswith(prefix))
 
-    for node in F.nodes():
-        random_probs.append(np.random.exponential(0.03))
 
-    y = sorted(probs)
-    y_1 = sorted(random_probs)
-    x = range(len(probs))
+def distribution_data():
+    # Degree of each node of the original network from facebook.txt
+    deg = degree_stats.graph_degrees('facebook_combined.txt')
+
+    probs = deg / deg.max() * 0.7
+    random_probs = np.random.exponential(0.03, len(deg))
+
+    return np.sort(probs), np.sort(random_probs)
+
+
+def distribution_plot(data=None, filename=None):
+    if data is None:
+        data = distribution_data()
+
+    y, y_1 = data
+    x = range(len(y))
 
     sns.set_style("white")
     plt.rc('font', family='Raleway')
@@ -52,7 +102,7 @@ def distribution_plot():
     plt.yticks([i/10 for i in range(0, 9, 1)])
     plt.xlim([0, 4050])
     plt.xticks([0, 1000, 2000, 3000, 4000])
-    plt.show()
+    finish_plot(filename)
 
 
 def read_file(filename):
@@ -71,7 +121,7 @@ def read_file(filename):
     return data_dict
 
 
-def num_influencers_plot(data):
+def num_influencers_plot(data, filename=None):
     x = []
     clicks_y = []
     views_y = []
@@ -97,18 +147,18 @@ def num_influencers_plot(data):
     ax2.set_ylabel('Clicks per View', color='r')
     ax2.tick_params('y', colors='r')
 
-    plt.show()
+    finish_plot(filename)
 
 
 def composition_data(influencers, threshold=False):
     cpvs = []
 
     if influencers:
-        n, m = 0, 28
+        prefix = 'influencers_'
     else:
-        n, m = 28, len(os.listdir("./output_data"))
+        prefix = 'output_data_'
 
-    for file in os.listdir("./output_data")[n:m]:
+    for file in output_files('./output_data', prefix):
         filename = './output_data/' + file
         data = read_file(filename)
         best_cpv = 0
@@ -129,37 +179,31 @@ def composition_data(influencers, threshold=False):
     return sorted(cpvs, key=itemgetter(0), reverse=True)
 
 
-def degree_dist(G):
-    degree_dist = {}
-    for i in G.nodes():
-        degree_dist[i] = len(G.neighbors(i))
+def degree_dist(deg):
+    # Number of nodes with each degree that occurs in the degree sequence
+    histogram = degree_stats.degree_histogram(deg)
+    present = np.flatnonzero(histogram)
 
-    dd_plot_data = {}
-    for n, d in degree_dist.items():
-        if d in dd_plot_data:
-            dd_plot_data[d] += 1
-        else:
-            dd_plot_data[d] = 1
+    return dict(zip(present.tolist(), histogram[present].tolist()))
 
-    return dd_plot_data
 
+def degree_distribution_data():
+    G = degree_stats.graph_degrees(
+        './simulation_networks/pa_parsed_4039.edgelist')
+    F = degree_stats.graph_degrees('facebook_combined.txt')
 
-def degree_distribution_plot():
-    G = nx.read_edgelist('./simulation_networks/pa_parsed_4039.edgelist')
-    F = nx.Graph()
+    return degree_dist(G), degree_dist(F)
 
-    # Create original network from facebook.txt
-    with open('facebook_combined.txt', 'r') as file:
-        for line in file:
-            if line[0] != '#':
-                F.add_edge(int(line.strip().split(' ')[0]),
-                           int(line.strip().split(' ')[1]),
-                           strength=0)
 
-    g_x_vals = [n for n in degree_dist(G).keys()]
-    g_y_vals = [n for n in degree_dist(G).values()]
-    f_x_vals = [n for n in degree_dist(F).keys()]
-    f_y_vals = [n for n in degree_dist(F).values()]
+def degree_distribution_plot(data=None, filename=None):
+    if data is None:
+        data = degree_distribution_data()
+
+    g_dist, f_dist = data
+    g_x_vals = [n for n in g_dist.keys()]
+    g_y_vals = [n for n in g_dist.values()]
+    f_x_vals = [n for n in f_dist.keys()]
+    f_y_vals = [n for n in f_dist.values()]
 
     sns.set_style("white")
     plt.rc('font', family='Raleway')
@@ -177,10 +221,45 @@ def degree_distribution_plot():
     plt.ylim([-5, 400])
     plt.yticks([i for i in range(0, 450, 50)])
     plt.xlim([0, 1100])
-    plt.show()
+    finish_plot(filename)
+
+
+def degree_ccdf_data(filenames):
+    comparison = degree_stats.compare_degree_distributions(filenames)
+    return [(filename, data['ccdf'], data['summary']['power_law'])
+            for filename, data in comparison.items()]
+
 
+def degree_ccdf_plot(data=None, filename=None):
+    # Log-log degree CCDF of each graph with its fitted power law tail
+    if data is None:
+        data = degree_ccdf_data(CCDF_FILES)
 
-def composition_plot(data):
+    sns.set_style("white")
+    plt.rc('font', family='Raleway')
+
+    labels = []
+    for graph, (k, p), fit in data:
+        line = plt.loglog(k, p, marker='.', linestyle='none', markersize=3)
+        labels.append(os.path.basename(graph))
+        # A graph without positive degrees has no fit to draw
+        if fit is None:
+            continue
+        tail = k >= fit['k_min']
+        scale = p[tail][0]
+        plt.loglog(k[tail], scale * (k[tail] / fit['k_min']) **
+                   (1 - fit['alpha']), c=line[0].get_color(), linewidth=1)
+        labels.append('alpha = ' + str(round(fit['alpha'], 2)))
+
+    plt.legend(labels=labels, loc=3, markerscale=3)
+
+    sns.despine()
+    plt.xlabel('Degree')
+    plt.ylabel('P(Degree >= k)')
+    finish_plot(filename)
+
+
+def composition_plot(data, filename=None):
     order = ['4_6', '5_5', '6_4', '7_3', '8_2', '9_1', '10_0',
              '8_12', '10_10', '12_8', '14_6', '16_4', '18_2', '20_0',
              '12_18', '15_15', '18_12', '21_9', '24_6', '27_3', '30_0',
@@ -248,13 +327,13 @@ def composition_plot(data):
     ax2.yaxis.tick_right()
     plt.xlim([-1, len(values)+1])
 
-    plt.show()
+    finish_plot(filename)
 
 
 def large_composition_data(k, threshold):
-    k10_files = os.listdir("./additional_output_data")[:28]
-    k20_files = os.listdir("./additional_output_data")[28:56]
-    k4_files = os.listdir("./additional_output_data")[56:]
+    k10_files = output_files('./additional_output_data', 'pa_parsed_10000_')
+    k20_files = output_files('./additional_output_data', 'pa_parsed_20000_')
+    k4_files = output_files('./additional_output_data', 'pa_parsed_4039_')
 
     if k == 4:
         k_files = k4_files
@@ -289,10 +368,11 @@ def large_composition_data(k, threshold):
     return sorted(cpvs, key=itemgetter(0), reverse=True)
 
 
-def large_composition_plot():
-    k4_data = large_composition_data(4, False)
-    k10_data = large_composition_data(10, False)
-    k20_data = large_composition_data(20, False)
+def large_composition_plot(data=None, filename=None):
+    if data is None:
+        data = [large_composition_data(k, False) for k in [4, 10, 20]]
+
+    k4_data, k10_data, k20_data = data
 
     order = ['4_6', '5_5', '6_4', '7_3', '8_2', '9_1', '10_0',
              '8_12', '10_10', '12_8', '14_6', '16_4', '18_2', '20_0',
@@ -389,15 +469,74 @@ def large_composition_plot():
     ax1.set_ylabel('Clicks per View')
     plt.xlim([-1, len(plot_labels) + 1])
 
-    plt.show()
+    finish_plot(filename)
+
+
+def large_composition_datasets():
+    return [large_composition_data(k, False) for k in [4, 10, 20]]
+
+
+def figure_jobs(directory, fmt):
+    # List the report figures as (name, input files, data function, data
+    # arguments, plot function, output filename)
+    output = ['./output_data/' + file for file in
+              output_files('./output_data', 'influencers_')]
+    additional = ['./additional_output_data/' + file for file in
+                  output_files('./additional_output_data', 'pa_parsed_')]
+    pa_file = './simulation_networks/pa_parsed_4039.edgelist'
+
+    jobs = [
+        ('probability_distribution', ['facebook_combined.txt'],
+         distribution_data, (), distribution_plot),
+        ('degree_distribution', ['facebook_combined.txt', pa_file],
+         degree_distribution_data, (), degree_distribution_plot),
+        ('degree_ccdf', CCDF_FILES, degree_ccdf_data, (CCDF_FILES,),
+         degree_ccdf_plot),
+        ('num_influencers', [INFLUENCERS_FILE], read_file,
+         (INFLUENCERS_FILE,), num_influencers_plot),
+        ('composition', output, composition_data, (True, True),
+         composition_plot),
+        ('large_composition', additional, large_composition_datasets, (),
+         large_composition_plot)
+    ]
+
+    return [job + (os.path.join(directory, job[0] + '.' + fmt),)
+            for job in jobs]
+
+
+def render_figure(job):
+    # Compute (or load from the cache) the data for a figure and save it
+    # without a display
+    name, inputs, data_func, args, plot_func, filename = job
+    plt.switch_backend('Agg')
+    data = cached(name, inputs, data_func, *args)
+    plot_func(data, filename)
+
+    return filename
+
+
+def render_all(directory='./figures', fmt='png', processes=None):
+    # Render every report figure to directory in parallel
+    os.makedirs(directory, exist_ok=True)
+    with Pool(processes) as pool:
+        return pool.map(render_figure, figure_jobs(directory, fmt))
 
 
 def main():
+    # Set batch true to save all figures to ./figures instead of showing them
+    batch = False
+
+    if batch:
+        render_all()
+        return
+
     distribution_plot()
 
     degree_distribution_plot()
 
-    data = read_file('./additional_output_data/influencers_4_6.txt')
+    degree_ccdf_plot()
+
+    data = read_file(INFLUENCERS_FILE)
     num_influencers_plot(data)
 
     sorted_data = composition_data(influencers=True, threshold=True)
@@ -0,0 +1,219 @@
+import numpy as np
+from scipy import sparse
+
+import cascade
+from network import MAX_ITERATIONS, clicks_per_view
+
+
+def strength_matrices(graph, threshold):
+    # Sparse adjacency matrices of the strong and weak neighbors of each node
+    n = len(graph['probability'])
+    indices, split = cascade.split_neighbors(graph, threshold)
+    indptr = graph['indptr']
+    positions = np.arange(len(indices))
+    rows = np.repeat(np.arange(n), np.diff(indptr))
+    strong = positions < split[rows]
+    ones = np.ones(len(indices))
+
+    return (sparse.csr_matrix((ones[strong], (rows[strong], indices[strong])),
+                              shape=(n, n)),
+            sparse.csr_matrix((ones[~strong],
+                               (rows[~strong], indices[~strong])),
+                              shape=(n, n)))
+
+
+def expected_spread(graph, compositions, items, threshold, limit,
+                    tolerance=1e-3):
+    # Deterministic (mean-field) approximation of the Ad-Serve process for a
+    # batch of cells, each an Ad-Serve composition and number of starting
+    # items. Rather than sampling, the probability of each node having seen
+    # and clicked the ad is propagated round by round, for every cell at once
+    # as sparse matrix products over the strong and weak adjacency. A node
+    # that clicked in the previous round fills its slots from the expected
+    # number of unseen strong, weak and random nodes, with the same leftover
+    # rules as graph_test, and each unseen node is shown the ad with the
+    # resulting probability.
+    #
+    # A cascade only continues while some node clicks, so each round is
+    # weighted by the probability the cascade is still running (treating the
+    # number of new clicks as Poisson), and the state carried into the next
+    # round is conditioned on at least one click. A cell stops once that
+    # probability falls below tolerance, or its views reach the limit.
+    compositions = np.asarray(compositions, dtype=np.float64)
+    items = np.asarray(items)
+    n_cells = len(items)
+    p = graph['probability'][:, None]
+    n = len(p)
+    strong, weak = strength_matrices(graph, threshold)
+    strong_t = strong.T.tocsr()
+    weak_t = weak.T.tocsr()
+    strong_degree = np.asarray(strong.sum(axis=1))
+    weak_degree = np.asarray(weak.sum(axis=1))
+
+    # State is held as (nodes, cells). Each cell starts from its `items` most
+    # probable nodes.
+    rank = np.empty(n, dtype=np.int64)
+    rank[np.argsort(-p[:, 0], kind='stable')] = np.arange(n)
+    seen = (rank[:, None] < items[None, :]).astype(np.float64)
+    frontier = seen.copy()
+
+    # Expected statistics, and probability each cascade is still running
+    views = items.astype(np.float64)
+    clicks = items.astype(np.float64)
+    iterations = np.zeros(n_cells)
+    alive = np.ones(n_cells)
+
+    results = [None] * n_cells
+    active = np.arange(n_cells)
+    iteration = 0
+
+    while len(active):
+        state = seen[:, active]
+        iterations[active] += alive[active]
+
+        # Expected unseen strong, weak and random nodes for every node
+        u_strong = strong_degree - strong @ state
+        u_weak = weak_degree - weak @ state
+        u_random = np.maximum(n - state.sum(axis=0) - u_strong - u_weak, 0)
+
+        # Expected slot allocation of a node that clicked, following the
+        # strong, weak, then leftover strong, weak and random fill order
+        want_strong = compositions[active, 0]
+        want_weak = compositions[active, 1]
+        a_strong = np.minimum(want_strong, u_strong)
+        a_weak = np.minimum(want_weak, u_weak)
+        leftovers = want_strong + want_weak - a_strong - a_weak
+        extra = np.minimum(leftovers, u_strong - a_strong)
+        a_strong += extra
+        leftovers -= extra
+        extra = np.minimum(leftovers, u_weak - a_weak)
+        a_weak += extra
+        leftovers -= extra
+        a_random = np.minimum(leftovers, u_random)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rate_strong = np.where(u_strong > 0, a_strong / u_strong, 0)
+            rate_weak = np.where(u_weak > 0, a_weak / u_weak, 0)
+            rate_random = np.where(u_random > 0, a_random / u_random, 0)
+
+        # Expected number of times each unseen node is picked by the clicked
+        # nodes it is a strong or weak neighbor of, and by the random slots.
+        # Clicked nodes are processed in turn and never pick a node that has
+        # already been shown the ad, so picks within a round do not overlap
+        # and the expected picks are capped at one.
+        x = frontier[:, active]
+        picks = strong_t @ (x * rate_strong) + weak_t @ (x * rate_weak)
+        picks += np.sum(x * rate_random, axis=0)
+
+        new_seen = (1 - state) * np.minimum(picks, 1)
+        new_clicks = new_seen * p
+        seen[:, active] = state + new_seen
+        views[active] += alive[active] * new_seen.sum(axis=0)
+        clicks[active] += alive[active] * new_clicks.sum(axis=0)
+
+        # Probability of at least one new click, which keeps the cascade
+        # running into the next round
+        progress = -np.expm1(-new_clicks.sum(axis=0))
+        frontier[:, active] = new_clicks / np.where(progress > 0, progress, 1)
+        reached = seen[:, active].sum(axis=0) >= limit
+        alive[active] *= np.where(reached, 1, progress)
+
+        still_active = []
+        for k, at_limit in zip(active, reached):
+            if at_limit:
+                condition = 'views upper limit'
+            elif alive[k] < tolerance:
+                condition = 'no progress'
+            elif iteration >= MAX_ITERATIONS:
+                condition = 'iteration upper limit'
+            else:
+                still_active.append(k)
+                continue
+            results[k] = {
+                'composition': compositions[k].astype(int).tolist(),
+                'items': int(items[k]),
+                'iterations': iterations[k],
+                'views': views[k],
+                'clicks': clicks[k],
+                'cpv': clicks_per_view(items[k], clicks[k], views[k]),
+                'condition': condition
+            }
+        active = np.array(still_active, dtype=np.int64)
+
+        iteration += 1
+
+    return results
+
+
+def screen(graph, compositions, seed_counts, threshold, limit):
+    # Mean-field estimates for every (composition, seed count) cell of the
+    # grid, best clicks per view first
+    estimates = []
+    for items in seed_counts:
+        estimates.extend(expected_spread(graph, compositions,
+                                         [items] * len(compositions),
+                                         threshold, limit))
+
+    return sorted(estimates, key=lambda cell: cell['cpv'], reverse=True)
+
+
+def monte_carlo(graph, composition, items, threshold, limit, n_runs,
+                seed=123):
+    # Sample n_runs independent cascades of one cell with the array engine.
+    # Without shared slots the campaigns of run_campaigns do not interact,
+    # so every run is simulated in the same pass.
+    runs = cascade.run_campaigns(graph, [composition] * n_runs,
+                                 [items] * n_runs, threshold, limit,
+                                 seed=seed)
+    return {'views': np.array([run[2] for run in runs], dtype=np.float64),
+            'clicks': np.array([run[1] for run in runs], dtype=np.float64)}
+
+
+def approximation_error(graph, composition, items, threshold, limit,
+                        n_runs=100, seed=123):
+    # Compare the mean-field estimate of a cell with the mean of sampled
+    # runs. For each statistic reports both estimates, the relative error and
+    # the error in units of the Monte Carlo standard error.
+    estimate = expected_spread(graph, [composition], [items], threshold,
+                               limit)[0]
+    sampled = monte_carlo(graph, composition, items, threshold, limit,
+                          n_runs, seed)
+
+    report = {'composition': composition, 'items': items}
+    for key in ['views', 'clicks', 'cpv']:
+        if key == 'cpv':
+            # Clicks per view of the mean clicks and views, as graphs.py
+            # reports it, with a bootstrap standard error
+            mean = clicks_per_view(items, sampled['clicks'].mean(),
+                                   sampled['views'].mean())
+            rs = np.random.RandomState(seed)
+            resamples = rs.randint(n_runs, size=(200, n_runs))
+            standard_error = np.std([
+                clicks_per_view(items, sampled['clicks'][r].mean(),
+                                sampled['views'][r].mean())
+                for r in resamples])
+        else:
+            mean = sampled[key].mean()
+            standard_error = sampled[key].std(ddof=1) / np.sqrt(n_runs)
+        error = estimate[key] - mean
+        report[key] = {
+            'mean_field': estimate[key],
+            'monte_carlo': mean,
+            'relative_error': error / mean if mean else np.nan,
+            'z_score': error / standard_error if standard_error else np.nan
+        }
+
+    return report
+
+
+def screen_then_sample(graph, compositions, seed_counts, threshold, limit,
+                       top=5, n_runs=100, seed=123):
+    # Screen the whole grid with the mean-field estimate, then run Monte
+    # Carlo only on the `top` most promising cells, reporting how far the
+    # estimate was from the sampled runs for each of them
+    estimates = screen(graph, compositions, seed_counts, threshold, limit)
+
+    return estimates, [approximation_error(graph, cell['composition'],
+                                           cell['items'], threshold, limit,
+                                           n_runs, seed)
+                       for cell in estimates[:top]]
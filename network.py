@@ -3,6 +3,19 @@ import numpy as np
 from tqdm import tqdm
 from operator import itemgetter
 
+import strength
+
+
+# A cascade is stopped after this many iterations
+MAX_ITERATIONS = 100
+
+# Seed of the common random numbers drawn for each replicate
+CRN_SEED = 123
+
+# Per-iteration statistics recorded by graph_test when tracing a cascade
+TRACE_FIELDS = ['new_views', 'new_clicks', 'frontier', 'strong_slots',
+                'weak_slots', 'random_slots', 'leftovers']
+
 
 def assign_probabilities(n,
                          filename='./simulation_networks/fb_parsed.edgelist'):
@@ -51,19 +64,30 @@ def create_parsed_graph(filename='./simulation_networks/fb_parsed.edgelist'):
                                int(line.strip().split(' ')[1]),
                                strength=0)
 
-    strength_dict = {}
-
-    # Add 'strength of connection' as weight to each edge
-    for node in tqdm(F.nodes()):
-        nbrs = F.neighbors(node)
-        for nbr in nbrs:
-            nbr_nbrs = F.neighbors(nbr)
-            # Strength of connection is determined as ratio of shared neighbors
-            strength_dict[(node, nbr)] = (len(
-                [i for i in nbrs if i in nbr_nbrs])) / len(nbrs)
+    # Add 'strength of connection' as weight to each edge. Strength of
+    # connection is determined as ratio of shared neighbors, along with the
+    # other strength_metrics, computed in parallel shards unless
+    # strength_processes is 0 (the other metrics then in a single process),
+    # or estimated from MinHash sketches if strength_sketch is set. The ratio
+    # is always stored first, as 'strength'.
+    metrics = ['strength'] + [metric for metric in strength_metrics
+                              if metric != 'strength']
+    strength.check_metrics(metrics)
+    if strength_sketch:
+        strength_dicts = strength.sketched_strengths(F, strength_sketch,
+                                                     metrics)
+    elif strength_processes == 0:
+        strength_dicts = {'strength': strength.serial_strengths(F)}
+        if len(metrics) > 1:
+            strength_dicts.update(strength.sharded_strengths(F, 1,
+                                                             metrics[1:]))
+    else:
+        strength_dicts = strength.sharded_strengths(F, strength_processes,
+                                                    metrics)
 
     # Assign edge attributes
-    nx.set_edge_attributes(F, 'strength', strength_dict)
+    for metric in metrics:
+        nx.set_edge_attributes(F, metric, strength_dicts[metric])
 
     # Write the edgelist to file
     nx.write_edgelist(F, filename)
@@ -95,9 +119,15 @@ def read_graph(filename):
             # If the line doesn't have probability information:
             if line.split(' ')[1] != 'probability':
                 s = line.split(' ')[3].strip()[:-2]
-                # Add edge with strength attribute
+                # Any other strength metrics follow strength
+                metrics = {}
+                for field in line.split(' ', 2)[2].strip()[1:-1].split(
+                        ', ')[1:]:
+                    key, value = field.split(': ')
+                    metrics[key[1:-1]] = float(value)
+                # Add edge with strength attributes
                 G.add_edge(node, int(line.split(' ')[1]),
-                           strength=float(s))
+                           strength=float(s), **metrics)
             else:
                 continue
 
@@ -105,6 +135,228 @@ def read_graph(filename):
     return G
 
 
+def write_graph(G, filename):
+    # Write a graph built by read_graph back to file, in the same format as
+    # the parsed graphs it was read from. read_graph drops the last digit of
+    # each strength, so a guard digit is written after it and the graph
+    # reads back unchanged.
+    with open(filename, 'w') as file:
+        for u, v, data in G.edges(data=True):
+            fields = ["'strength': " + repr(float(data['strength'])) + '0']
+            fields.extend(["'" + key + "': " + repr(value)
+                           for key, value in data.items()
+                           if key != 'strength'])
+            file.write(str(u) + ' ' + str(v) + ' {' + ', '.join(fields) +
+                       '}\n')
+        for node in G.nodes():
+            file.write(str(node) + ' probability ' +
+                       str(G.node[node]['probability']) + '\n')
+
+
+def parsed_strength(value):
+    # A strength as read_graph reads it back from a parsed graph file, which
+    # drops the last digit of the written value
+    return float(repr(float(value))[:-1])
+
+
+def edge_source(G, u, v, order):
+    # Source of the strength stored on edge (u, v). create_parsed_graph keeps
+    # the direction whose source comes later in its own node order, which is
+    # lost by the time the graph is read back, so the source is the endpoint
+    # whose ratio of shared neighbors matches the stored strength. Where both
+    # match (equal degrees, or no shared neighbors) either gives the same
+    # strength, and the endpoint later in the given node order is used.
+    if order[u] < order[v]:
+        u, v = v, u
+    shared = len(set(G[u]) & set(G[v]))
+    stored = G[u][v]['strength']
+
+    if abs(parsed_strength(shared / G.degree(v)) - stored) < \
+            abs(parsed_strength(shared / G.degree(u)) - stored):
+        return v
+    return u
+
+
+def edge_strength(G, source, target):
+    # Strength of connection of an edge under each metric stored on it, with
+    # the given endpoint as the source
+    return strength.edge_metrics(G, source, target,
+                                 list(G[source][target]))
+
+
+def nearby_edges(G, nodes, shared_degrees=False):
+    # Edges incident to any of the given nodes, as (smaller, larger) node
+    # pairs. With shared_degrees, also the edges between two neighbors of
+    # one of the nodes, which have it as a shared neighbor.
+    edges = set()
+    for node in nodes:
+        nbrs = set(G[node])
+        for nbr in nbrs:
+            edges.add((min(node, nbr), max(node, nbr)))
+            if shared_degrees:
+                for other in nbrs & set(G[nbr]):
+                    edges.add((min(nbr, other), max(nbr, other)))
+
+    return edges
+
+
+def node_probability(G, node):
+    # Base case probability of a node under the current probability model
+    if influencers:
+        return (G.degree(node) / max_degree) * 0.7
+    else:
+        return np.random.exponential(0.03)
+
+
+def update_edges(G, insertions=(), deletions=()):
+    # Apply a batch of edge insertions and deletions to a graph built by
+    # read_graph, keeping edge strengths, influencers probabilities and the
+    # maximum degree current without rebuilding the graph. Only the edges
+    # incident to the changed endpoints can have a different number of
+    # shared neighbors or source degree, so only those strengths are
+    # recomputed, along with the edges between their neighbors when a stored
+    # metric depends on the degrees of shared neighbors. Returns the number
+    # of edges whose strength was recomputed.
+    global max_degree
+
+    # The maximum degree can only fall if a node at the maximum loses an edge
+    at_max = any(G.degree(node) == max_degree for edge in deletions
+                 for node in edge if node in G)
+
+    # New edges carry the same strength metrics as the rest of the graph
+    metrics = ['strength']
+    for u, v, data in G.edges_iter(data=True):
+        metrics = list(data)
+        break
+    shared_degrees = any(metric in strength.NEIGHBOR_DEGREE_METRICS
+                         for metric in metrics)
+
+    # Source of the stored strength of every edge that may be recomputed,
+    # found before any degree changes. Sources are kept on the graph, as a
+    # later batch could leave both endpoints matching the stored strength.
+    order = {node: i for i, node in enumerate(G.nodes())}
+    sources = G.graph.setdefault('strength_sources', {})
+    endpoints = set(node for edge in list(insertions) + list(deletions)
+                    for node in edge if node in G)
+    for u, v in nearby_edges(G, endpoints, shared_degrees):
+        if (u, v) not in sources:
+            sources[(u, v)] = edge_source(G, u, v, order)
+
+    changed = set()
+    for u, v in deletions:
+        if G.has_edge(u, v):
+            G.remove_edge(u, v)
+            sources.pop((min(u, v), max(u, v)), None)
+            changed.update([u, v])
+
+    for u, v in insertions:
+        for node in [u, v]:
+            if node not in G:
+                G.add_node(node, {'probability': 0, 'seen': False,
+                                  'clicked': False, 'seen_last': False,
+                                  'clicked_last': False})
+                G.node[node]['probability'] = node_probability(G, node)
+        if not G.has_edge(u, v):
+            G.add_edge(u, v, dict.fromkeys(metrics, 0))
+            changed.update([u, v])
+
+    # Recompute the strength of every edge around a changed endpoint, in the
+    # direction it was stored in, and store it as read_graph would read it
+    # from a rebuilt graph. New edges take the endpoint later in the node
+    # order as their source.
+    order = {node: i for i, node in enumerate(G.nodes())}
+    affected = nearby_edges(G, changed, shared_degrees)
+    for u, v in affected:
+        if (u, v) not in sources:
+            sources[(u, v)] = u if order[u] > order[v] else v
+        source = sources[(u, v)]
+        target = v if source == u else u
+        values = edge_strength(G, source, target)
+        values['strength'] = parsed_strength(values['strength'])
+        G[u][v].update(values)
+
+    # Degree based probabilities only change for the changed endpoints,
+    # unless the maximum degree changed, in which case every node is rescaled
+    if influencers and changed:
+        if at_max:
+            new_max = max(G.degree().values())
+        else:
+            new_max = max([max_degree] +
+                          [G.degree(node) for node in changed])
+
+        if new_max != max_degree:
+            max_degree = new_max
+            to_update = G.nodes()
+        else:
+            to_update = changed
+        for node in to_update:
+            G.node[node]['probability'] = node_probability(G, node)
+
+    return len(affected)
+
+
+def add_metric(G, metric):
+    # Compute a strength metric on every edge of a graph built by read_graph
+    # that does not already store it, so the metric get_nbrs classifies by
+    # can be changed without recreating the graphs. Only 'strength' depends
+    # on the direction of an edge, and parsed graphs always store it.
+    strength.check_metrics([metric])
+    for u, v, data in G.edges_iter(data=True):
+        if metric in data:
+            return
+        break
+
+    nx.set_edge_attributes(G, metric,
+                           strength.sharded_strengths(G, 1, [metric])[metric])
+
+
+def check_update_edges(G, insertions, tolerance=1e-12):
+    # Insert a batch of new edges into a graph built by read_graph with
+    # update_edges, delete them again and return the edges whose attributes,
+    # and the nodes whose probability, are not restored. Both should be
+    # empty. Attributes are compared with a tolerance, as sums over shared
+    # neighbors (adamic_adar, resource_allocation) can be recomputed in a
+    # different order than the batch pass that wrote them.
+    insertions = [(u, v) for u, v in insertions
+                  if not (u in G and v in G and G.has_edge(u, v))]
+    new_nodes = set(node for edge in insertions for node in edge
+                    if node not in G)
+    edges = {(u, v): dict(data) for u, v, data in G.edges_iter(data=True)}
+    probabilities = {node: G.node[node]['probability'] for node in G}
+
+    update_edges(G, insertions=insertions)
+    update_edges(G, deletions=insertions)
+    G.remove_nodes_from(new_nodes)
+
+    changed_edges = [edge for edge, data in edges.items()
+                     if any(abs(G[edge[0]][edge[1]][key] - value) > tolerance
+                            for key, value in data.items())]
+    changed_nodes = [node for node, probability in probabilities.items()
+                     if abs(G.node[node]['probability'] - probability) >
+                     tolerance]
+
+    return changed_edges, changed_nodes
+
+
+def check_write_graph(filename, copy_filename):
+    # Read a parsed graph, write it to copy_filename with write_graph and
+    # read the copy back, returning the edges whose attributes, and the
+    # nodes whose probability, differ. Both should be empty, so a graph can
+    # be read, updated and written any number of times.
+    G = read_graph(filename)
+    write_graph(G, copy_filename)
+    H = read_graph(copy_filename)
+
+    changed_edges = [(u, v) for u, v, data in G.edges_iter(data=True)
+                     if not H.has_edge(u, v) or H[u][v] != data]
+    changed_nodes = [node for node in G
+                     if node not in H or
+                     H.node[node]['probability'] !=
+                     G.node[node]['probability']]
+
+    return changed_edges, changed_nodes
+
+
 def increase_prob(strength, probability, degree):
     if influencers:
         # Use the influencers probability model
@@ -130,7 +382,7 @@ def check_stop(G, iteration, clicked, clicked_prev):
     elif clicked == clicked_prev:
         return True, 'no progress'
     # If over 100 iterations have been conducted
-    elif iteration >= 100:
+    elif iteration >= MAX_ITERATIONS:
         return True, 'iteration upper limit'
     else:
         return False, None
@@ -138,19 +390,20 @@ def check_stop(G, iteration, clicked, clicked_prev):
 
 def get_nbrs(G, node, strength, threshold):
     # Generate lists of strong, weak or random neighbors for a given node.
-    # Strong/weak classification is based on some threshold of shared
-    # neighbors.
+    # Strong/weak classification is based on some threshold of the
+    # strength_metric edge attribute (by default the ratio of shared
+    # neighbors).
 
     if strength == 'strong':
         # Find all neighbors who have edge strength over the threshold
         nbrs = [i for i in G.neighbors(node) if G[node][i][
-            'strength'] > threshold]
+            strength_metric] > threshold]
         # Remove those who have already seen the ad
         return [i for i in nbrs if G.node[i]['seen'] is False]
     elif strength == 'weak':
         # Find all neighbors who have edge strength under the threshold
         nbrs = [i for i in G.neighbors(node) if G[node][i][
-            'strength'] <= threshold]
+            strength_metric] <= threshold]
         # Remove those who have already seen the ad
         return [i for i in nbrs if G.node[i]['seen'] is False]
     else:
@@ -160,9 +413,11 @@ def get_nbrs(G, node, strength, threshold):
         return [i for i in nbrs if G.node[i]['seen'] is False]
 
 
-def update_clicks(G):
+def update_clicks(G, draws=None):
     # Generate list of nodes to test based on whether they saw the ad in the
-    # last iteration
+    # last iteration. draws is None to use the global random stream, or the
+    # (node index, click uniforms) of the current iteration when using common
+    # random numbers.
     to_test = []
     for node in G.nodes():
         if G.node[node]['seen_last'] is True:
@@ -171,14 +426,48 @@ def update_clicks(G):
     # For each node, randomly check if their probability results in a click or
     # not
     for node in to_test:
-        if np.random.random() < G.node[node]['probability']:
+        if draws is None:
+            u = np.random.random()
+        else:
+            u = draws[1][draws[0][node]]
+        if u < G.node[node]['probability']:
             G.node[node]['clicked'] = True
             G.node[node]['clicked_last'] = True
 
 
-def graph_test(items, threshold, composition, filename):
+def new_trace(*shape):
+    # Preallocate trace arrays for cascades, one row per possible iteration
+    # and one column per TRACE_FIELDS entry
+    return np.zeros(shape + (MAX_ITERATIONS + 1, len(TRACE_FIELDS)),
+                    dtype=np.int32)
+
+
+def crn_draws(replicate, nodes):
+    # Pre-draw the common random numbers of a replicate: a click uniform and
+    # a slot-sampling seed for every (iteration, node). Nodes are indexed in
+    # sorted order so the same node always receives the same draws.
+    index = {node: i for i, node in enumerate(sorted(nodes))}
+    rs = np.random.RandomState([CRN_SEED, replicate])
+    click_uniforms = rs.random_sample((MAX_ITERATIONS + 1, len(index)))
+    slot_seeds = rs.randint(2 ** 32, size=(MAX_ITERATIONS + 1, len(index)),
+                            dtype=np.uint32)
+
+    return index, click_uniforms, slot_seeds
+
+
+def graph_test(items, threshold, composition, filename, trace=None,
+               replicate=None):
+    # If a trace array (see new_trace) is given, the statistics in
+    # TRACE_FIELDS are recorded in it for each iteration of the cascade. If a
+    # replicate is given, the cascade uses that replicate's common random
+    # numbers instead of the global random stream, so every composition and
+    # seed count tested against the replicate sees the same draws.
 
     G = read_graph(filename)
+    add_metric(G, strength_metric)
+
+    if replicate is not None:
+        index, click_uniforms, slot_seeds = crn_draws(replicate, G.nodes())
 
     node_list = []
     for i in G.nodes(data=True):
@@ -211,8 +500,19 @@ def graph_test(items, threshold, composition, filename):
             G.node[node]['seen_last'] = False
             G.node[node]['clicked_last'] = False
 
+        # Slots filled from each pool and left unfilled in this iteration
+        slots = [0, 0, 0, 0]
+
         # For each node that clicked the ad in the previous iteration
         for node in latest_clicks:
+            # Sample this node's slots from its own common random stream if
+            # using common random numbers
+            if replicate is None:
+                choice = np.random.choice
+            else:
+                choice = np.random.RandomState(
+                    slot_seeds[iteration, index[node]]).choice
+
             # For each neighbor of this node
             for nbr in G.neighbors(node):
                 # Increase probability according to edge strength
@@ -231,50 +531,59 @@ def graph_test(items, threshold, composition, filename):
 
             # Find 10 nodes to show the ads to based on Ad-Serve composition:
             if composition[0] < len(strong_nbrs):
-                to_show.extend(np.random.choice(strong_nbrs,
-                                                size=composition[0],
-                                                replace=False))
+                to_show.extend(choice(strong_nbrs,
+                                      size=composition[0],
+                                      replace=False))
                 strong_remain = [i for i in strong_nbrs if i not in to_show]
             else:
                 to_show.extend(strong_nbrs)
                 strong_remain = []
                 leftovers += composition[0] - len(strong_nbrs)
+            n_strong = len(to_show)
 
             if composition[1] < len(weak_nbrs):
-                to_show.extend(np.random.choice(weak_nbrs,
-                                                size=composition[1],
-                                                replace=False))
+                to_show.extend(choice(weak_nbrs,
+                                      size=composition[1],
+                                      replace=False))
                 weak_remain = [i for i in weak_nbrs if i not in to_show]
             else:
                 to_show.extend(weak_nbrs)
                 weak_remain = []
                 leftovers += composition[1] - len(weak_nbrs)
+            n_weak = len(to_show) - n_strong
 
             if leftovers > 0 and leftovers > len(strong_remain):
                 # Fill with strong neighbors
                 to_show.extend(strong_remain)
                 leftovers -= len(strong_remain)
             elif leftovers > 0:
-                to_show.extend(np.random.choice(strong_remain,
-                                                size=leftovers, replace=False))
+                to_show.extend(choice(strong_remain,
+                                      size=leftovers, replace=False))
                 leftovers = 0
+            n_strong += len(to_show) - n_strong - n_weak
 
             # Fill with weak neighbors
             if leftovers > 0 and leftovers > len(weak_remain):
                 to_show.extend(weak_remain)
                 leftovers -= len(weak_remain)
             elif leftovers > 0:
-                to_show.extend(np.random.choice(weak_remain,
-                                                size=leftovers, replace=False))
+                to_show.extend(choice(weak_remain,
+                                      size=leftovers, replace=False))
                 leftovers = 0
+            n_weak += len(to_show) - n_strong - n_weak
 
             # Fill with random neighbors
             if leftovers > 0 and leftovers > len(random_nbrs):
                 to_show.extend(random_nbrs)
             elif leftovers > 0:
-                to_show.extend(np.random.choice(random_nbrs,
-                                                size=leftovers,
-                                                replace=False))
+                to_show.extend(choice(random_nbrs,
+                                      size=leftovers,
+                                      replace=False))
+
+            slots[0] += n_strong
+            slots[1] += n_weak
+            slots[2] += len(to_show) - n_strong - n_weak
+            slots[3] += sum(composition) - len(to_show)
 
             # Update node characteristics for nodes that are shown the ad
             for node in to_show:
@@ -283,7 +592,10 @@ def graph_test(items, threshold, composition, filename):
 
         # Test each node to see if it clicked the ad or not based on
         # adjusted probabilities
-        update_clicks(G)
+        if replicate is None:
+            update_clicks(G)
+        else:
+            update_clicks(G, (index, click_uniforms[iteration]))
 
         # Generate summary statistics
         clicked_list = []
@@ -295,6 +607,11 @@ def graph_test(items, threshold, composition, filename):
                 seen_list.append(node)
 
         clicked = len(clicked_list)
+
+        if trace is not None:
+            trace[iteration] = [sum(slots[:3]), clicked - clicked_prev,
+                                len(latest_clicks)] + slots
+
         # Check stopping condition
         stop, condition = check_stop(G, iteration, clicked, clicked_prev)
         clicked_prev = clicked
@@ -330,50 +647,45 @@ def run_base_case():
     print(np.std(click_list))
 
 
-def simulation(composition, threshold, items, n_graphs):
+def simulation(composition, threshold, items, n_graphs, trace=None):
     # List of possible newsfeed item breakdowns (strong, weak, random) to be
-    # tested
+    # tested. If a trace array is given, the cascade of each graph tested is
+    # recorded in the corresponding row.
 
     iterations = []
     clicks = []
     views = []
     conditions = []
 
-    # If using prefential attachment
-    if pref_attachment:
-        # Set filename
-        filename = current_file_to_test
+    # The influencers model has a single probability assignment, otherwise
+    # each randomly assigned graph is tested. With common random numbers
+    # every graph is a replicate with its own draws, so the influencers graph
+    # is tested once per replicate.
+    if influencers and not common_random_numbers:
+        graphs = [0]
+    else:
+        graphs = tqdm(range(n_graphs))
 
-    if influencers:
-        # Set filename
-        if not pref_attachment:
-            filename = './simulation_networks/fb_parsed_influencers.edgelist'
+    # For each graph to be tested
+    for graph in graphs:
+        filename = graph_filename(graph)
 
         # Test the graph
         iteration, clicked, seen, condition = \
-            graph_test(items, threshold, composition, filename)
+            graph_test(items, threshold, composition, filename,
+                       None if trace is None else trace[graph],
+                       graph if common_random_numbers else None)
 
         # Append output statistics
         iterations.append(iteration)
         clicks.append(clicked)
         views.append(seen)
         conditions.append(condition)
-    else:
-        # For each graph to be tested
-        for graph in tqdm(range(n_graphs)):
-            filename = ''.join(['./simulation_networks/fb_parsed_', str(graph),
-                                '.edgelist'])
 
-            # Test the graph
-            iteration, clicked, seen, condition = \
-                graph_test(items, threshold, composition, filename)
+    return summarise_runs(iterations, clicks, views, conditions)
 
-            # Append output statistics
-            iterations.append(iteration)
-            clicks.append(clicked)
-            views.append(seen)
-            conditions.append(condition)
 
+def summarise_runs(iterations, clicks, views, conditions):
     # Create condition dictionary
     condition_dict = {'views upper limit': 0,
                       'no progress': 0,
@@ -395,6 +707,54 @@ def simulation(composition, threshold, items, n_graphs):
     return output_data
 
 
+def clicks_per_view(items, clicked, seen):
+    # Additional clicks per additional view, as used in graphs.py
+    if seen == items:
+        return 0
+    return (clicked - items) / (seen - items)
+
+
+def compare_compositions(composition_a, composition_b, threshold, items,
+                         n_replicates, n_permutations=10000):
+    # Paired comparison of the clicks per view of two Ad-Serve compositions,
+    # both evaluated against the same common random numbers in each
+    # replicate
+    cpv_a = []
+    cpv_b = []
+    for replicate in tqdm(range(n_replicates)):
+        filename = graph_filename(replicate)
+        for composition, cpvs in [(composition_a, cpv_a),
+                                  (composition_b, cpv_b)]:
+            iteration, clicked, seen, condition = \
+                graph_test(items, threshold, composition, filename,
+                           replicate=replicate)
+            cpvs.append(clicks_per_view(items, clicked, seen))
+
+    cpv_a = np.array(cpv_a)
+    cpv_b = np.array(cpv_b)
+    diff = cpv_a - cpv_b
+    paired_se = np.std(diff, ddof=1) / np.sqrt(n_replicates)
+    unpaired_se = np.sqrt((np.var(cpv_a, ddof=1) +
+                           np.var(cpv_b, ddof=1)) / n_replicates)
+
+    # Sign-flip permutation test of a zero mean paired difference
+    rs = np.random.RandomState(CRN_SEED)
+    signs = rs.choice([-1, 1], size=(n_permutations, n_replicates))
+    flipped = np.abs((signs * diff).mean(axis=1))
+    p_value = (np.sum(flipped >= abs(diff.mean())) + 1) / \
+        (n_permutations + 1)
+
+    return {
+        'mean_cpv_a': cpv_a.mean(),
+        'mean_cpv_b': cpv_b.mean(),
+        'mean_difference': diff.mean(),
+        'paired_standard_error': paired_se,
+        'unpaired_standard_error': unpaired_se,
+        't_statistic': diff.mean() / paired_se if paired_se > 0 else np.inf,
+        'p_value': p_value
+    }
+
+
 def write_header_information(composition, filename):
     # Write file header information
     with open(filename, 'w') as file:
@@ -409,6 +769,16 @@ def write_footer_information(filename):
         file.write('}')
 
 
+def write_trace(filename, seed_counts, trace):
+    # Write the cascade traces of an Ad-Serve composition alongside its
+    # output data. trace has shape (seed counts, graphs, iterations, fields);
+    # iterations that were not run are all zero, and every iteration that was
+    # run has a non-zero frontier.
+    np.savez_compressed(filename[:-4] + '_trace.npz', trace=trace,
+                        items=np.array(seed_counts),
+                        fields=np.array(TRACE_FIELDS))
+
+
 def get_max_degree():
     F = nx.Graph()
 
@@ -434,16 +804,11 @@ def pref_attachment_graph(n, m):
     nx.write_edgelist(G, filename)
 
 
-def run_graph_simulation(strong_weak_threshold, create_run,
-                         possible_compositions, seeds, edges_to_add,
-                         number_of_graphs):
-    # Set seed
-    np.random.seed(123)
-
-    # Set limit
+def set_limit():
+    # Set the views upper limit used by check_stop
     global limit
     if pref_attachment:
-        limit = current_file_to_test[32:-9]
+        limit = int(current_file_to_test[32:-9])
         if limit != 4039:
             limit *= 0.975
         else:
@@ -455,59 +820,98 @@ def run_graph_simulation(strong_weak_threshold, create_run,
     global max_degree
     max_degree = get_max_degree()
 
+
+def create_graphs(edges_to_add, number_of_graphs):
+    # If simulation based on preferential attachment graphs
+    if pref_attachment:
+        # Create the random preferential attachment for given number
+        # of nodes
+        n = int(current_file_to_test[32:-9])
+        pref_attachment_graph(n, edges_to_add)
+        filename = current_file_to_test
+        # Parse the graph to find edge weights
+        create_parsed_graph(filename)
+        # Assign probabilties based on influencers model
+        assign_probabilities('0', filename)
+    elif influencers:
+        # Parse the graph to find edge weights
+        create_parsed_graph()
+        # Assign probabilties based on influencers model
+        assign_probabilities('0')
+    else:
+        # Parse the graph to find edge weights
+        create_parsed_graph()
+        # Assign probabilties based on random exponential model for each
+        # graph
+        for graph in tqdm(range(number_of_graphs)):
+            assign_probabilities(str(graph))
+
+
+def graph_filename(graph):
+    # Filename of the parsed graph used for the given probability draw
+    if influencers and pref_attachment:
+        return current_file_to_test
+    elif influencers:
+        return './simulation_networks/fb_parsed_influencers.edgelist'
+    else:
+        return ''.join(['./simulation_networks/fb_parsed_', str(graph),
+                        '.edgelist'])
+
+
+def output_filename(ad_serve):
+    # Filename the output data for an Ad-Serve composition is written to
+    if pref_attachment:
+        return './additional_output_data/' + \
+               current_file_to_test[22:37] + '_' + \
+               str(ad_serve[0]) + '_' + \
+               str(ad_serve[1]) + '.txt'
+    elif influencers:
+        return './output_data/influencers_' + \
+               str(ad_serve[0]) + '_' + \
+               str(ad_serve[1]) + '.txt'
+    else:
+        return './output_data/output_data_' + \
+               str(ad_serve[0]) + '_' + \
+               str(ad_serve[1]) + '.txt'
+
+
+def run_graph_simulation(strong_weak_threshold, create_run,
+                         possible_compositions, seeds, edges_to_add,
+                         number_of_graphs):
+    # Set seed
+    np.random.seed(123)
+
+    # Set limit and maximum degree
+    set_limit()
+
     # If graphs need to be created
     if create_run == 'create':
-        # If simulation based on preferential attachment graphs
-        if pref_attachment:
-            # Create the random preferential attachment for given number
-            # of nodes
-            pref_attachment_graph(current_file_to_test[32:-9], edges_to_add)
-            filename = current_file_to_test
-            # Parse the graph to find edge weights
-            create_parsed_graph(filename)
-            # Assign probabilties based on influencers model
-            assign_probabilities('0', filename)
-        elif influencers:
-            # Parse the graph to find edge weights
-            create_parsed_graph()
-            # Assign probabilties based on influencers model
-            assign_probabilities('0')
-        else:
-            # Parse the graph to find edge weights
-            create_parsed_graph()
-            # Assign probabilties based on random exponential model for each
-            # graph
-            for graph in tqdm(range(number_of_graphs)):
-                assign_probabilities(str(graph))
+        create_graphs(edges_to_add, number_of_graphs)
 
     # For each Ad-Serve composition that needs to be tested
     for ad_serve in possible_compositions:
         print("Current composition:", str(ad_serve))
 
         # Set output filename
-        if pref_attachment:
-            filename = './additional_output_data/' + \
-                       current_file_to_test[22:37] + '_' +\
-                       str(ad_serve[0]) + '_' + \
-                       str(ad_serve[1]) + '.txt'
-        elif influencers:
-            filename = './output_data/influencers_' + \
-                       str(ad_serve[0]) + '_' + \
-                       str(ad_serve[1]) + '.txt'
-        else:
-            filename = './output_data/output_data_' + \
-                       str(ad_serve[0]) + '_' + \
-                       str(ad_serve[1]) + '.txt'
+        filename = output_filename(ad_serve)
 
         # Write header information to file
         write_header_information(ad_serve, filename)
 
+        seed_counts = range(seeds[0], seeds[1], seeds[2])
+        if record_trace:
+            if influencers and not common_random_numbers:
+                trace = new_trace(len(seed_counts), 1)
+            else:
+                trace = new_trace(len(seed_counts), number_of_graphs)
+
         # For bottom to top seed range
-        for items in range(seeds[0], seeds[1], seeds[2]):
+        for i, items in enumerate(seed_counts):
             print("Current number of starting items:", str(items))
             # Run the simulation
             data = simulation(ad_serve, strong_weak_threshold, items,
-                              number_of_graphs)
+                              number_of_graphs,
+                              trace[i] if record_trace else None)
             # Write output data
             with open(filename, 'a') as file:
                 file.write('\t' + str(items) + ': ' + str(data) + '\n')
@@ -515,6 +919,9 @@ def run_graph_simulation(strong_weak_threshold, create_run,
         # Write footer information
         write_footer_information(filename)
 
+        if record_trace:
+            write_trace(filename, seed_counts, trace)
+
 
 def main():
     base_case = False
@@ -535,6 +942,37 @@ def main():
     # Set number of graphs to generate
     number_of_graphs = 20
 
+    # Set common_random_numbers true to evaluate every composition and seed
+    # count against the same pre-drawn random numbers in each replicate (one
+    # replicate per graph), for low variance comparisons between them
+    global common_random_numbers
+    common_random_numbers = False
+
+    # Set number of processes computing edge strengths when creating graphs
+    # (None for one per core, 0 for the original serial loop)
+    global strength_processes
+    strength_processes = None
+
+    # Set the tie-strength metrics stored on each edge when creating graphs
+    # (any of strength.STRENGTH_METRICS, 'strength' being the ratio of shared
+    # neighbors), and the one used to classify strong and weak neighbors.
+    # The threshold should suit the chosen metric.
+    global strength_metrics
+    strength_metrics = ['strength']
+    global strength_metric
+    strength_metric = 'strength'
+
+    # Set strength_sketch to a number of hash functions to estimate the
+    # strength, jaccard and overlap metrics from MinHash sketches of each
+    # node's neighbors instead of counting shared neighbors exactly (None)
+    global strength_sketch
+    strength_sketch = None
+
+    # Set record_trace true to write per-iteration cascade statistics
+    # alongside the output data
+    global record_trace
+    record_trace = False
+
     strong_weak_threshold = 0.5
 
     # Set list of compositions to be trialed
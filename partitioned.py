@@ -0,0 +1,352 @@
+import time
+from multiprocessing import Pipe, Process, RawArray, cpu_count
+
+import numpy as np
+
+import cascade
+import degree_stats
+import strength
+from network import MAX_ITERATIONS
+
+
+# Batches of candidates drawn when sampling random nodes, before falling back
+# to scanning every node
+RANDOM_ATTEMPTS = 4
+
+# Shared array type codes of the numpy dtypes held in shared memory
+TYPECODES = {np.dtype(np.int64): 'q', np.dtype(np.float64): 'd',
+             np.dtype(np.uint8): 'B'}
+
+
+def to_shared(values):
+    # Copy an array into shared memory. Returns the shared array and its
+    # dtype, for workers to view it with np.frombuffer.
+    values = np.asarray(values)
+    shared = RawArray(TYPECODES[values.dtype], len(values))
+    np.frombuffer(shared, dtype=values.dtype)[:] = values
+    return shared, values.dtype
+
+
+def shard_bounds(indptr, n_shards):
+    # Split the nodes into contiguous ranges with about equal numbers of
+    # edges (plus one per node), as the work of expanding a frontier grows
+    # with the degree of the clicked nodes. Returns the first node of each
+    # shard followed by the number of nodes.
+    work = np.cumsum(np.diff(indptr) + 1)
+    bounds = np.searchsorted(work, np.linspace(0, work[-1],
+                                               n_shards + 1)[1:-1])
+    return np.unique(np.concatenate([[0], bounds, [len(indptr) - 1]]))
+
+
+def sample_unseen(rs, seen, picked, nbrs, size):
+    # Uniform sample of size nodes that are unseen, not yet picked and not
+    # in nbrs, or all of them if there are fewer. While most nodes are
+    # unseen, candidates are drawn from all nodes and rejected, which avoids
+    # a pass over every node for each clicker.
+    n = len(seen)
+    accepted = np.zeros(0, dtype=np.int64)
+    for attempt in range(RANDOM_ATTEMPTS):
+        candidates = rs.randint(n, size=2 * size)
+        candidates = candidates[(seen[candidates] == 0) &
+                                ~picked[candidates] &
+                                ~np.isin(candidates, nbrs)]
+        accepted = np.concatenate([accepted, candidates])
+        # Distinct candidates in the order drawn
+        first = np.sort(np.unique(accepted, return_index=True)[1])
+        accepted = accepted[first]
+        if len(accepted) >= size:
+            return accepted[:size]
+
+    unseen = (seen == 0) & ~picked
+    unseen[nbrs] = False
+    unseen = np.flatnonzero(unseen)
+    if len(unseen) > size:
+        return rs.choice(unseen, size=size, replace=False)
+    return unseen
+
+
+def expand(rs, graph, picked, clickers, compositions):
+    # Choose the nodes shown the ad by each clicker of a shard in node order,
+    # as graph_test does, none picking a node already seen or picked by an
+    # earlier clicker. compositions gives the strong and weak slots of each
+    # clicker, plus any random slots it must fill. Returns the clicker of
+    # each pick and the picks.
+    indptr = graph['indptr']
+    indices = graph['indices']
+    split = graph['split']
+    seen = graph['seen']
+    clicked_by = [np.zeros(0, dtype=np.int64)]
+    shown = [np.zeros(0, dtype=np.int64)]
+
+    for node, composition in zip(clickers, compositions):
+        strong_all = indices[indptr[node]:split[node]]
+        weak_all = indices[split[node]:indptr[node + 1]]
+        nbrs = indices[indptr[node]:indptr[node + 1]]
+        strong_nbrs = strong_all[(seen[strong_all] == 0) &
+                                 ~picked[strong_all]]
+        weak_nbrs = weak_all[(seen[weak_all] == 0) & ~picked[weak_all]]
+
+        # A uniform sample of as many random nodes as could be needed, from
+        # which fill_slots chooses a uniform subset
+        def random_pool():
+            return sample_unseen(rs, seen, picked, nbrs,
+                                 composition[0] + composition[1])
+
+        to_show = cascade.fill_slots(rs, composition[:2], strong_nbrs,
+                                     weak_nbrs, random_pool)
+        picked[to_show] = True
+
+        # Random slots of nodes lost to other shards' clickers
+        if composition[2] > 0:
+            random_nbrs = sample_unseen(rs, seen, picked, nbrs,
+                                        composition[2])
+            picked[random_nbrs] = True
+            to_show = np.concatenate([to_show, random_nbrs])
+
+        clicked_by.append(np.full(len(to_show), node, dtype=np.int64))
+        shown.append(to_show)
+
+    shown = np.concatenate(shown)
+    picked[shown] = False
+
+    return np.concatenate(clicked_by), shown
+
+
+def lost_slots(graph, clickers, lost):
+    # Strong, weak and random slots of each clicker taken by an earlier
+    # clicker of another shard. Returns the clickers in node order and the
+    # [strong, weak, random] slots each must fill again.
+    indptr = graph['indptr']
+    indices = graph['indices']
+    split = graph['split']
+    order = np.argsort(clickers, kind='stable')
+    nodes, starts = np.unique(clickers[order], return_index=True)
+    compositions = []
+    for node, taken in zip(nodes.tolist(), np.split(lost[order], starts[1:])):
+        strong = np.isin(taken, indices[indptr[node]:split[node]]).sum()
+        weak = np.isin(taken, indices[split[node]:indptr[node + 1]]).sum()
+        compositions.append([int(strong), int(weak),
+                             len(taken) - int(strong) - int(weak)])
+
+    return nodes.tolist(), compositions
+
+
+def shard_worker(conn, arrays, shard):
+    # Serve one shard of a partitioned cascade engine. Each round the
+    # coordinator asks the shard to expand its part of the clicked frontier,
+    # returning the nodes its clickers show the ad to, then has it refill any
+    # slots lost to clickers of other shards, and finally hands it the newly
+    # seen nodes it owns, for which it draws clicks. Seen flags are in shared
+    # memory, written only by the coordinator between requests. Random
+    # numbers come from a stream seeded by the cascade seed and the shard, so
+    # a cascade is reproducible for a given seed and number of shards.
+    graph = {key: np.frombuffer(shared, dtype=dtype)
+             for key, (shared, dtype) in arrays.items()}
+    picked = np.zeros(len(graph['seen']), dtype=bool)
+
+    while True:
+        message = conn.recv()
+
+        if message[0] == 'start':
+            composition, seed, frontier = message[1:]
+            composition = list(composition) + [0]
+            rs = np.random.RandomState([seed, shard])
+            conn.send(None)
+
+        elif message[0] == 'expand':
+            conn.send(expand(rs, graph, picked, frontier.tolist(),
+                             [composition] * len(frontier)))
+
+        elif message[0] == 'refill':
+            conn.send(expand(rs, graph, picked,
+                             *lost_slots(graph, *message[1:])))
+
+        elif message[0] == 'click':
+            # Newly seen nodes of this shard, in node order
+            owned = message[1]
+            frontier = owned[rs.random_sample(len(owned)) <
+                             graph['probability'][owned]]
+            conn.send(len(frontier))
+
+        else:
+            conn.close()
+            break
+
+
+def start_shards(graph, threshold, processes=None):
+    # Start a partitioned cascade engine on a graph read by
+    # cascade.read_arrays, with one shard process per core by default. The
+    # adjacency (with strong neighbors first), probabilities and seen flags
+    # are placed in shared memory once and reused by every cascade run on
+    # the engine.
+    if processes is None:
+        processes = cpu_count()
+    indices, split = cascade.split_neighbors(graph, threshold)
+    n = len(graph['probability'])
+    arrays = {
+        'indptr': to_shared(graph['indptr'].astype(np.int64)),
+        'indices': to_shared(indices.astype(np.int64)),
+        'split': to_shared(split.astype(np.int64)),
+        'probability': to_shared(graph['probability'].astype(np.float64)),
+        'seen': to_shared(np.zeros(n, dtype=np.uint8))
+    }
+
+    engine = {
+        'bounds': shard_bounds(graph['indptr'], processes),
+        'probability': np.frombuffer(arrays['probability'][0]),
+        'seen': np.frombuffer(arrays['seen'][0], dtype=np.uint8),
+        'processes': [],
+        'conns': []
+    }
+    for shard in range(len(engine['bounds']) - 1):
+        conn, child = Pipe()
+        process = Process(target=shard_worker, args=(child, arrays, shard),
+                          daemon=True)
+        process.start()
+        engine['processes'].append(process)
+        engine['conns'].append(conn)
+
+    return engine
+
+
+def stop_shards(engine):
+    # Stop the shard processes of an engine
+    for conn in engine['conns']:
+        conn.send(('stop',))
+    for process in engine['processes']:
+        process.join()
+
+
+def owners(engine, nodes):
+    # Shard owning each of the given nodes
+    return np.searchsorted(engine['bounds'], nodes, side='right') - 1
+
+
+def exchange(engine, command, requests):
+    # Send a request to every shard and gather the picks they return, in
+    # shard order and so in order of the clickers making them
+    for conn, request in zip(engine['conns'], requests):
+        conn.send((command,) + request)
+    replies = [conn.recv() for conn in engine['conns']]
+
+    return (np.concatenate([reply[0] for reply in replies]),
+            np.concatenate([reply[1] for reply in replies]))
+
+
+def run_cascade(engine, composition, items, limit, seed=None):
+    # Run one cascade of the Ad-Serve process across the shards of an
+    # engine, starting from the items most probable nodes. Each round every
+    # shard expands its clicked nodes in parallel and the impressions are
+    # exchanged through the coordinator. A node picked by clickers in
+    # several shards goes to the first clicker in node order, as in
+    # graph_test, and the others refill the lost slots from the nodes still
+    # unseen, until no picks clash. Each shard then draws the clicks of the
+    # newly seen nodes it owns, and the stopping criteria of check_stop are
+    # applied to the global seen and clicked counts. Returns (iteration,
+    # clicked, seen, condition).
+    if seed is None:
+        seed = np.random.randint(2 ** 31)
+    conns = engine['conns']
+    n_shards = len(conns)
+    seen = engine['seen']
+    seen[:] = 0
+
+    ranked = np.argsort(-engine['probability'], kind='stable')
+    generators = np.sort(ranked[:items])
+    seen[generators] = 1
+    owner = owners(engine, generators)
+    for shard, conn in enumerate(conns):
+        conn.send(('start', composition, seed, generators[owner == shard]))
+    for conn in conns:
+        conn.recv()
+
+    seen_count = len(generators)
+    clicked_count = len(generators)
+    iteration = 0
+
+    while True:
+        clickers, picks = exchange(engine, 'expand', [()] * n_shards)
+        shown = []
+        while len(picks):
+            # Keep the first pick of each node, marking it seen, and return
+            # the clashing picks to the shards of their clickers
+            first = np.unique(picks, return_index=True)[1]
+            kept = np.zeros(len(picks), dtype=bool)
+            kept[first] = True
+            seen[picks[kept]] = 1
+            shown.append(picks[kept])
+
+            owner = owners(engine, clickers[~kept])
+            clickers, picks = clickers[~kept], picks[~kept]
+            if len(picks) == 0:
+                break
+            clickers, picks = exchange(engine, 'refill', [
+                (clickers[owner == shard], picks[owner == shard])
+                for shard in range(n_shards)])
+
+        shown = np.sort(np.concatenate(shown)) if shown else \
+            np.zeros(0, dtype=np.int64)
+        owner = owners(engine, shown)
+        for shard, conn in enumerate(conns):
+            conn.send(('click', shown[owner == shard]))
+        clicks = sum(conn.recv() for conn in conns)
+
+        # Check the stopping criteria
+        seen_count += len(shown)
+        clicked_prev = clicked_count
+        clicked_count += clicks
+        if seen_count >= limit:
+            condition = 'views upper limit'
+        elif clicked_count == clicked_prev:
+            condition = 'no progress'
+        elif iteration >= MAX_ITERATIONS:
+            condition = 'iteration upper limit'
+        else:
+            iteration += 1
+            continue
+
+        return iteration + 1, clicked_count, seen_count, condition
+
+
+def benchmark_graph(n, m, mean_probability=0.03, seed=123):
+    # A large preferential attachment graph in the layout of
+    # cascade.read_arrays, with shared neighbor ratio strengths and
+    # exponential probabilities, for timing cascades without a parsed file
+    edges = degree_stats.pa_edges(n, m, seed)
+    rows = edges.ravel()
+    cols = edges[:, ::-1].ravel()
+    order = np.argsort(rows, kind='stable')
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(rows,
+                                                        minlength=n))])
+    indices = cols[order]
+
+    keys = strength.edge_keys(indptr, indices)
+    shared = strength.neighbor_sums(indptr, indices, keys, 0,
+                                    len(indices))[0]
+    degree = np.diff(indptr)
+
+    return {
+        'nodes': np.arange(n),
+        'probability': np.random.RandomState(seed).exponential(
+            mean_probability, n),
+        'indptr': indptr,
+        'indices': indices,
+        'strength': shared / np.repeat(degree, degree)
+    }
+
+
+def main():
+    n = 200000
+    graph = benchmark_graph(n, 10)
+
+    for processes in [1, 2, 4, 8]:
+        engine = start_shards(graph, 0.5, processes)
+        start = time.time()
+        result = run_cascade(engine, [20, 20], 40, int(n * 0.975), seed=123)
+        print(processes, 'processes:', result,
+              round(time.time() - start, 2), 'seconds')
+        stop_shards(engine)
+
+
+if __name__ == '__main__':
+    main()
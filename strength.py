@@ -0,0 +1,517 @@
+import time
+from array import array
+from multiprocessing import Pool, RawArray, cpu_count
+
+import networkx as nx
+import numpy as np
+from tqdm import tqdm
+
+
+# Shards per worker process, so that shards finishing early do not leave
+# processes idle
+SHARDS_PER_PROCESS = 4
+
+# Wedges (a directed edge and one neighbor of its source) tested at a time
+# by a worker, bounding its temporary memory
+CHUNK_WEDGES = 2 ** 22
+
+# Edges hashed into the MinHash sketches at a time
+SKETCH_CHUNK = 2 ** 16
+
+# Metrics that can be estimated from MinHash sketches
+SKETCH_METRICS = ['strength', 'jaccard', 'overlap']
+
+# Shared read-only arrays of a worker process, set by init_worker
+worker_arrays = {}
+
+
+def serial_strengths(F):
+    # Strength of connection of every directed edge as the ratio of shared
+    # neighbors to the source degree, as create_parsed_graph computed it
+    strength_dict = {}
+
+    for node in tqdm(F.nodes()):
+        nbrs = F.neighbors(node)
+        for nbr in nbrs:
+            nbr_nbrs = F.neighbors(nbr)
+            strength_dict[(node, nbr)] = (len(
+                [i for i in nbrs if i in nbr_nbrs])) / len(nbrs)
+
+    return strength_dict
+
+
+def adjacency(F):
+    # CSR adjacency of a NetworkX graph, with nodes in F.nodes() order and
+    # each node's neighbors in F.neighbors() order. Returns the nodes,
+    # indptr and indices.
+    nodes = F.nodes()
+    index = {node: i for i, node in enumerate(nodes)}
+    indptr = np.zeros(len(nodes) + 1, dtype=np.int64)
+    indices = array('q')
+
+    for i, node in enumerate(nodes):
+        indices.extend(index[nbr] for nbr in F.neighbors(node))
+        indptr[i + 1] = len(indices)
+
+    return nodes, indptr, np.frombuffer(indices, dtype=np.int64)
+
+
+def ratio(shared, source_degree, target_degree, aa_sum, ra_sum):
+    # Shared neighbors over the source degree, the original strength of
+    # connection. Not symmetric: the direction written last to the
+    # undirected edge is kept.
+    return shared / source_degree
+
+
+def jaccard(shared, source_degree, target_degree, aa_sum, ra_sum):
+    # Shared neighbors over the neighbors of either endpoint
+    return shared / (source_degree + target_degree - shared)
+
+
+def overlap(shared, source_degree, target_degree, aa_sum, ra_sum):
+    # Shared neighbors over the smaller of the two degrees
+    return shared / np.minimum(source_degree, target_degree)
+
+
+def adamic_adar(shared, source_degree, target_degree, aa_sum, ra_sum):
+    # Sum of 1 / log(degree) over the shared neighbors
+    return aa_sum
+
+
+def resource_allocation(shared, source_degree, target_degree, aa_sum,
+                        ra_sum):
+    # Sum of 1 / degree over the shared neighbors
+    return ra_sum
+
+
+# Tie-strength metrics of a directed edge, each computed from the number of
+# shared neighbors, the degrees of the source and target, and the sums of
+# 1 / log(degree) and 1 / degree over the shared neighbors. Each is stored as
+# the edge attribute of the same name; 'strength' is the original ratio.
+STRENGTH_METRICS = {
+    'strength': ratio,
+    'jaccard': jaccard,
+    'overlap': overlap,
+    'adamic_adar': adamic_adar,
+    'resource_allocation': resource_allocation
+}
+
+# Metrics that also depend on the degrees of the shared neighbors, so change
+# on every edge between two neighbors of a node whose degree changes
+NEIGHBOR_DEGREE_METRICS = ['adamic_adar', 'resource_allocation']
+
+
+def wedge_sums(indptr, indices, keys, sources, targets):
+    # Number of shared neighbors of the directed edges (sources, targets) of
+    # a CSR adjacency, and the sums of 1 / log(degree) and 1 / degree over
+    # them. keys holds source * n + target of every directed edge, sorted,
+    # so that each neighbor x of an edge's source is a shared neighbor if
+    # (target, x) is an edge.
+    n = len(indptr) - 1
+    degree = np.diff(indptr)
+    wedges = degree[sources]
+    counts = np.zeros(len(sources), dtype=np.int64)
+    aa_sums = np.zeros(len(sources))
+    ra_sums = np.zeros(len(sources))
+
+    if len(sources) == 0:
+        return counts, aa_sums, ra_sums
+
+    # A shared neighbor is adjacent to both endpoints, so has degree >= 2
+    with np.errstate(divide='ignore'):
+        inverse_log = 1 / np.log(degree)
+        inverse = 1 / degree
+
+    # Split the edges into chunks of about CHUNK_WEDGES wedges
+    ends = np.cumsum(wedges)
+    bounds = np.searchsorted(ends, np.arange(CHUNK_WEDGES, ends[-1],
+                                             CHUNK_WEDGES), side='right')
+    bounds = np.unique(np.concatenate([[0], bounds, [len(sources)]]))
+
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        sizes = wedges[start:stop]
+        owner = np.repeat(np.arange(stop - start), sizes)
+        first = np.cumsum(sizes) - sizes
+        positions = (indptr[sources[start:stop]][owner] +
+                     np.arange(len(owner)) - first[owner])
+        wanted = targets[start:stop][owner] * n + indices[positions]
+        found = np.searchsorted(keys, wanted)
+        found = keys[np.minimum(found, len(keys) - 1)] == wanted
+
+        owner = owner[found]
+        shared = indices[positions[found]]
+        counts[start:stop] = np.bincount(owner, minlength=stop - start)
+        aa_sums[start:stop] = np.bincount(owner, weights=inverse_log[shared],
+                                          minlength=stop - start)
+        ra_sums[start:stop] = np.bincount(owner, weights=inverse[shared],
+                                          minlength=stop - start)
+
+    return counts, aa_sums, ra_sums
+
+
+def neighbor_sums(indptr, indices, keys, lo, hi):
+    # wedge_sums of the directed edges lo..hi of a CSR adjacency
+    sources = np.searchsorted(indptr, np.arange(lo, hi), side='right') - 1
+    return wedge_sums(indptr, indices, keys, sources, indices[lo:hi])
+
+
+def edge_keys(indptr, indices):
+    # Sorted source * n + target of every directed edge
+    n = len(indptr) - 1
+    sources = np.repeat(np.arange(n), np.diff(indptr))
+    return np.sort(sources * n + indices)
+
+
+def shared_array(values):
+    # Copy an int64 array into shared memory
+    shared = RawArray('q', len(values))
+    np.frombuffer(shared, dtype=np.int64)[:] = values
+    return shared
+
+
+def init_worker(indptr, indices, keys, output, metrics):
+    # Keep numpy views of the shared arrays for the shards of this process
+    worker_arrays['indptr'] = np.frombuffer(indptr, dtype=np.int64)
+    worker_arrays['indices'] = np.frombuffer(indices, dtype=np.int64)
+    worker_arrays['keys'] = np.frombuffer(keys, dtype=np.int64)
+    worker_arrays['output'] = np.frombuffer(
+        output, dtype=np.float64).reshape(len(metrics), -1)
+    worker_arrays['metrics'] = metrics
+
+
+def strength_shard(shard):
+    # Write every metric of the directed edges of a node range straight into
+    # the shared output array, one row per metric
+    first, last = shard
+    indptr = worker_arrays['indptr']
+    indices = worker_arrays['indices']
+    lo, hi = indptr[first], indptr[last]
+    sums = neighbor_sums(indptr, indices, worker_arrays['keys'], lo, hi)
+
+    degree = np.diff(indptr)
+    source_degree = np.repeat(degree[first:last], degree[first:last])
+    target_degree = degree[indices[lo:hi]]
+    for row, metric in enumerate(worker_arrays['metrics']):
+        worker_arrays['output'][row, lo:hi] = STRENGTH_METRICS[metric](
+            sums[0], source_degree, target_degree, sums[1], sums[2])
+
+    return last - first
+
+
+def node_shards(indptr, n_shards):
+    # Split the nodes into contiguous ranges of about equal work, counted in
+    # wedges (the square of the degree)
+    degree = np.diff(indptr)
+    work = np.cumsum(degree * degree)
+    if len(work) == 0 or work[-1] == 0:
+        return [(0, len(degree))]
+    bounds = np.searchsorted(work,
+                             np.linspace(0, work[-1], n_shards + 1)[1:-1])
+    bounds = np.unique(np.concatenate([[0], bounds, [len(degree)]]))
+
+    return list(zip(bounds[:-1].tolist(), bounds[1:].tolist()))
+
+
+def sharded_strengths(F, processes=None, metrics=('strength',)):
+    # Strengths of every directed edge under each of the given metrics,
+    # computed in one pass from a CSR adjacency in node-range shards by a
+    # pool of worker processes. The adjacency is shared read only by every
+    # process and each shard writes its strengths into a preallocated shared
+    # array. 'strength' is the same integer division as in serial_strengths,
+    # so is bit-identical to it. Returns a strength dict per metric.
+    nodes, indptr, indices = adjacency(F)
+    keys = edge_keys(indptr, indices)
+    output = RawArray('d', len(metrics) * len(indices))
+    shared = (shared_array(indptr), shared_array(indices), shared_array(keys),
+              output, list(metrics))
+
+    if processes is None:
+        processes = cpu_count()
+    shards = node_shards(indptr, processes * SHARDS_PER_PROCESS)
+
+    if processes == 1:
+        init_worker(*shared)
+        for shard in tqdm(shards):
+            strength_shard(shard)
+    else:
+        with Pool(processes, initializer=init_worker,
+                  initargs=shared) as pool:
+            with tqdm(total=len(nodes)) as bar:
+                for done in pool.imap_unordered(strength_shard, shards):
+                    bar.update(done)
+
+    # Strengths keyed by directed edge, in the same order serial_strengths
+    # produces them
+    edges = list(zip(np.repeat(nodes, np.diff(indptr)).tolist(),
+                     np.array(nodes)[indices].tolist()))
+    output = np.frombuffer(output, dtype=np.float64).reshape(len(metrics), -1)
+
+    return {metric: dict(zip(edges, row.tolist()))
+            for metric, row in zip(metrics, output)}
+
+
+def check_metrics(metrics, supported=STRENGTH_METRICS, context=''):
+    # Raise a ValueError naming any metric that is not supported
+    unknown = [metric for metric in metrics if metric not in supported]
+    if unknown:
+        raise ValueError('unsupported strength metric(s) ' +
+                         ', '.join(unknown) + context + ': choose from ' +
+                         ', '.join(supported))
+
+
+def csr_metric(indptr, indices, metric):
+    # Strength of every directed edge of a CSR adjacency under one metric,
+    # in a single pass, for graphs read without that metric stored
+    check_metrics([metric])
+    keys = edge_keys(indptr, indices)
+    shared, aa_sums, ra_sums = neighbor_sums(indptr, indices, keys, 0,
+                                             len(indices))
+    degree = np.diff(indptr)
+
+    return STRENGTH_METRICS[metric](shared, np.repeat(degree, degree),
+                                    degree[indices], aa_sums, ra_sums)
+
+
+def edge_metrics(F, u, v, metrics=('strength',)):
+    # Strengths of the directed edge (u, v) under each of the given metrics,
+    # for updating single edges without a batch pass
+    shared = set(F[u]) & set(F[v])
+    degrees = np.array([F.degree(x) for x in shared], dtype=np.float64)
+
+    return {metric: float(STRENGTH_METRICS[metric](
+        len(shared), F.degree(u), F.degree(v), np.sum(1 / np.log(degrees)),
+        np.sum(1 / degrees))) for metric in metrics}
+
+
+def splitmix64(x):
+    # SplitMix64 finaliser, a fast well-mixed 64-bit hash of uint64 arrays
+    x = x + np.uint64(0x9E3779B97F4A7C15)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def hash_seeds(k, seed=123):
+    # Seeds of k independent hash functions
+    return splitmix64(np.arange(k, dtype=np.uint64) + np.uint64(seed))
+
+
+def node_hashes(labels, seeds):
+    # 32-bit hashes of node labels under each hash function, (nodes, k)
+    x = labels.astype(np.uint64)[:, None] ^ seeds[None, :]
+    return (splitmix64(x) >> np.uint64(32)).astype(np.uint32)
+
+
+def sketch_size(error):
+    # Hash functions needed for a standard error of at most error on the
+    # estimated Jaccard similarity, which is at most 1 / (2 sqrt(k))
+    return int(np.ceil(0.25 / error ** 2))
+
+
+def edge_chunks(filename, size=SKETCH_CHUNK):
+    # Stream an edge list (facebook_combined.txt or a NetworkX edgelist) as
+    # (size, 2) arrays of integer node labels
+    edges = array('q')
+    with open(filename, 'r') as file:
+        for line in file:
+            if line[0] == '#':
+                continue
+            fields = line.split(None, 2)
+            if len(fields) < 2 or fields[1] == 'probability':
+                continue
+            edges.append(int(fields[0]))
+            edges.append(int(fields[1]))
+            if len(edges) == 2 * size:
+                yield np.frombuffer(edges, dtype=np.int64).reshape(-1, 2)
+                edges = array('q')
+    if len(edges):
+        yield np.frombuffer(edges, dtype=np.int64).reshape(-1, 2)
+
+
+def minhash_sketches(chunks, k=64, seed=123):
+    # MinHash sketch of every node's neighborhood, built in one pass over
+    # chunks of undirected edges whose labels are used as node indices. For
+    # each of k hash functions a node keeps the smallest hash of any of its
+    # neighbors, so two sketches agree in a fraction of hash functions that
+    # estimates the Jaccard similarity of the neighborhoods. Returns the
+    # (nodes, k) sketches and the degree of each node.
+    seeds = hash_seeds(k, seed)
+    empty = np.iinfo(np.uint32).max
+    sketches = np.full((0, k), empty, dtype=np.uint32)
+    degree = np.zeros(0, dtype=np.int64)
+
+    for edges in chunks:
+        edges = edges[edges[:, 0] != edges[:, 1]]
+        if len(edges) == 0:
+            continue
+
+        # Grow the sketches to cover the largest label seen so far
+        n = int(edges.max()) + 1
+        if n > len(degree):
+            sketches = np.vstack([sketches, np.full((n - len(degree), k),
+                                                    empty, dtype=np.uint32)])
+            degree = np.concatenate([degree,
+                                     np.zeros(n - len(degree), np.int64)])
+
+        sources = edges.ravel()
+        targets = edges[:, ::-1].ravel()
+        degree += np.bincount(sources, minlength=len(degree))
+
+        # Smallest hash of the targets of each source in this chunk
+        order = np.argsort(sources, kind='stable')
+        sources = sources[order]
+        starts = np.flatnonzero(np.r_[True, sources[1:] != sources[:-1]])
+        minimum = np.minimum.reduceat(node_hashes(targets[order], seeds),
+                                      starts, axis=0)
+        nodes = sources[starts]
+        sketches[nodes] = np.minimum(sketches[nodes], minimum)
+
+    return sketches, degree
+
+
+def sketch_estimates(sketches, degree, sources, targets,
+                     metrics=('strength',), shared=None):
+    # Estimate the metrics of directed edges from the MinHash sketches of
+    # their endpoints. The number of shared neighbors follows from the
+    # estimated Jaccard similarity J and the exact degrees as
+    # J (d_source + d_target) / (1 + J), capped at what the degrees allow.
+    # Edges whose shared neighbors are known (shared not NaN) use them
+    # instead.
+    jaccard = np.empty(len(sources))
+    for start in range(0, len(sources), SKETCH_CHUNK):
+        stop = start + SKETCH_CHUNK
+        jaccard[start:stop] = np.mean(sketches[sources[start:stop]] ==
+                                      sketches[targets[start:stop]], axis=1)
+
+    source_degree = degree[sources]
+    target_degree = degree[targets]
+    estimated = np.clip(jaccard * (source_degree + target_degree) /
+                        (1 + jaccard), 0,
+                        np.minimum(source_degree, target_degree) - 1)
+    if shared is not None:
+        known = ~np.isnan(shared)
+        estimated[known] = shared[known]
+        jaccard[known] = shared[known] / (source_degree[known] +
+                                          target_degree[known] -
+                                          shared[known])
+
+    estimates = {
+        'strength': estimated / source_degree,
+        'jaccard': jaccard,
+        'overlap': estimated / np.minimum(source_degree, target_degree)
+    }
+
+    return np.array([estimates[metric] for metric in metrics])
+
+
+def sketched_strengths(F, k=64, metrics=('strength',), seed=123,
+                       exact_degree=None):
+    # Approximate strengths of every directed edge under each of the given
+    # metrics that SKETCH_METRICS supports, from MinHash sketches with k hash
+    # functions rather than exact shared neighbor counts. The sketches are
+    # least accurate when one endpoint has a much smaller degree than the
+    # other, so edges with an endpoint of degree at most exact_degree
+    # (default k) are counted exactly from that endpoint's neighbors, which
+    # keeps the cost linear in the number of edges. Returns a strength dict
+    # per metric, ordered as sharded_strengths. Other metrics cannot be
+    # estimated from the sketches and raise a ValueError.
+    check_metrics(metrics, SKETCH_METRICS, ' with MinHash sketches')
+    if exact_degree is None:
+        exact_degree = k
+    nodes, indptr, indices = adjacency(F)
+    degree = np.diff(indptr)
+    sources = np.repeat(np.arange(len(nodes)), degree)
+
+    # Each undirected edge once, streamed in chunks
+    upper = np.flatnonzero(sources < indices)
+    chunks = (np.column_stack([sources[upper[i:i + SKETCH_CHUNK]],
+                               indices[upper[i:i + SKETCH_CHUNK]]])
+              for i in range(0, len(upper), SKETCH_CHUNK))
+    sketches = minhash_sketches(chunks, k, seed)[0]
+
+    # Exact shared neighbors of low degree edges, from the smaller endpoint
+    small = np.minimum(degree[sources], degree[indices]) <= exact_degree
+    swap = degree[sources] > degree[indices]
+    first = np.where(swap, indices, sources)[small]
+    second = np.where(swap, sources, indices)[small]
+    shared = np.full(len(indices), np.nan)
+    shared[small] = wedge_sums(indptr, indices, edge_keys(indptr, indices),
+                               first, second)[0]
+
+    output = sketch_estimates(sketches, degree, sources, indices, metrics,
+                              shared)
+    edges = list(zip(np.repeat(nodes, degree).tolist(),
+                     np.array(nodes)[indices].tolist()))
+
+    return {metric: dict(zip(edges, row.tolist()))
+            for metric, row in zip(metrics, output)}
+
+
+def sketch_error(F, ks=(16, 64, 256), threshold=0.5, seed=123):
+    # Error of the sketched strengths against the exact ones, for each
+    # number of hash functions: the mean and largest absolute errors of the
+    # shared neighbor ratio, the fraction of edges whose strong / weak class
+    # at the threshold changes and the fraction of edges counted exactly,
+    # along with the time taken by each
+    start = time.time()
+    exact = np.array(list(sharded_strengths(F, 1)['strength'].values()))
+    report = {'exact_seconds': time.time() - start}
+
+    # Degree of the smaller endpoint of each directed edge
+    nodes, indptr, indices = adjacency(F)
+    degree = np.diff(indptr)
+    smaller_degree = np.minimum(np.repeat(degree, degree), degree[indices])
+
+    for k in ks:
+        start = time.time()
+        approximate = np.array(list(sketched_strengths(
+            F, k, seed=seed)['strength'].values()))
+        error = approximate - exact
+        report[k] = {
+            'exact_edges': float(np.mean(smaller_degree <= k)),
+            'seconds': time.time() - start,
+            'mean_abs_error': float(np.mean(np.abs(error))),
+            'max_abs_error': float(np.max(np.abs(error))),
+            'rmse': float(np.sqrt(np.mean(error ** 2))),
+            'flipped': float(np.mean((approximate > threshold) !=
+                                     (exact > threshold)))
+        }
+
+    return report
+
+
+def compare_strengths(F, processes_list=(1, 2, 4)):
+    # Time the serial and sharded strength computations, checking that the
+    # sharded strengths are bit-identical to the serial ones
+    start = time.time()
+    serial = serial_strengths(F)
+    report = {'serial': time.time() - start}
+
+    for processes in processes_list:
+        start = time.time()
+        sharded = sharded_strengths(F, processes)['strength']
+        report[processes] = {
+            'seconds': time.time() - start,
+            'identical': (list(sharded.items()) == list(serial.items()))
+        }
+
+    return report
+
+
+def main():
+    F = nx.Graph()
+    with open('facebook_combined.txt', 'r') as file:
+        for line in file:
+            if line[0] != '#':
+                F.add_edge(int(line.strip().split(' ')[0]),
+                           int(line.strip().split(' ')[1]))
+
+    for key, value in compare_strengths(F).items():
+        print(str(key) + ': ' + str(value))
+
+    for key, value in sketch_error(F).items():
+        print('sketch ' + str(key) + ': ' + str(value))
+
+
+if __name__ == '__main__':
+    main()
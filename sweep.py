@@ -0,0 +1,361 @@
+import argparse
+import json
+import multiprocessing
+import os
+import socket
+import sqlite3
+import threading
+import time
+import traceback
+
+import numpy as np
+
+import network
+
+
+# Cells are claimed for this many seconds at a time. A worker renews the lease
+# while it is running the cell, so the lease only expires if the worker dies.
+LEASE_SECONDS = 600
+
+# A cell whose lease has expired this many times is marked failed rather
+# than handed out again, so a cell that kills its worker cannot stall the sweep
+MAX_ATTEMPTS = 3
+
+
+def connect(db):
+    # Open the shared task store. The default rollback journal is used rather
+    # than WAL so the file can live on a shared (network) filesystem.
+    conn = sqlite3.connect(db, timeout=60, isolation_level=None)
+    conn.execute('PRAGMA busy_timeout = 60000')
+    return conn
+
+
+def create_store(db, config, cells):
+    # Write the sweep configuration and the cell grid into the task store
+    conn = connect(db)
+    conn.execute('BEGIN IMMEDIATE')
+    conn.execute('CREATE TABLE IF NOT EXISTS config '
+                 '(key TEXT PRIMARY KEY, value TEXT)')
+    conn.execute('CREATE TABLE IF NOT EXISTS cells ('
+                 'id INTEGER PRIMARY KEY, target TEXT, strong INTEGER, '
+                 'weak INTEGER, items INTEGER, graph INTEGER, '
+                 'status TEXT DEFAULT \'pending\', worker TEXT, '
+                 'lease_expires REAL, attempts INTEGER DEFAULT 0, '
+                 'iteration INTEGER, clicked INTEGER, seen INTEGER, '
+                 'condition TEXT)')
+    conn.execute('CREATE INDEX IF NOT EXISTS cells_status '
+                 'ON cells (status, lease_expires)')
+    # One cell per grid point, also for stores created before the index
+    conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS cells_grid '
+                 'ON cells (target, strong, weak, items, graph)')
+
+    for key, value in config.items():
+        conn.execute('INSERT OR REPLACE INTO config VALUES (?, ?)',
+                     (key, json.dumps(value)))
+
+    # Only add cells that are not already in the store, so re-running the
+    # coordinator against an existing sweep resumes it (adding any cells new
+    # to the grid) and retries any cells that failed
+    conn.executemany('INSERT OR IGNORE INTO cells (target, strong, weak, '
+                     'items, graph) VALUES (?, ?, ?, ?, ?)', cells)
+    conn.execute('UPDATE cells SET status = \'pending\', worker = NULL, '
+                 'attempts = 0, condition = NULL '
+                 'WHERE status = \'failed\'')
+    count = conn.execute('SELECT COUNT(*) FROM cells').fetchone()[0]
+    conn.execute('COMMIT')
+    conn.close()
+
+    return count
+
+
+def read_config(conn):
+    return {key: json.loads(value) for key, value in
+            conn.execute('SELECT key, value FROM config')}
+
+
+def configure(config, target):
+    # Set the module level parameters of network.py that main() would
+    # otherwise set for the given sweep target
+    network.influencers = config['influencers']
+    network.pref_attachment = config['pref_attachment']
+    network.common_random_numbers = config['common_random_numbers']
+    network.strength_processes = config['strength_processes']
+    network.strength_metrics = config['strength_metrics']
+    network.strength_metric = config['strength_metric']
+    network.strength_sketch = config['strength_sketch']
+    network.current_file_to_test = target
+    network.set_limit()
+
+
+def build_cells(config):
+    # Generate the grid of (target, strong, weak, items, graph) cells
+    if config['influencers'] and not config['common_random_numbers']:
+        graphs = [0]
+    else:
+        graphs = range(config['number_of_graphs'])
+
+    seeds = config['seeds']
+    cells = []
+    for target in config['targets']:
+        for ad_serve in config['possible_compositions']:
+            for items in range(seeds[0], seeds[1], seeds[2]):
+                for graph in graphs:
+                    cells.append((target, ad_serve[0], ad_serve[1], items,
+                                  graph))
+
+    return cells
+
+
+def coordinate(db, config, create_run):
+    # If graphs need to be created, do so once before any cell is handed out,
+    # seeded as run_graph_simulation seeds them
+    if create_run == 'create':
+        for target in config['targets']:
+            configure(config, target)
+            np.random.seed(config['seed'])
+            network.create_graphs(config['edges_to_add'],
+                                  config['number_of_graphs'])
+
+    count = create_store(db, config, build_cells(config))
+    print('Sweep store', db, 'holds', count, 'cells')
+
+
+def claim(conn, worker):
+    # Atomically lease the next pending cell, or a cell whose lease has
+    # expired because its worker died. Expired cells that have already been
+    # leased MAX_ATTEMPTS times are marked failed instead.
+    now = time.time()
+    conn.execute('BEGIN IMMEDIATE')
+    conn.execute('UPDATE cells SET status = \'failed\', condition = '
+                 '\'lease expired\' WHERE status = \'leased\' AND '
+                 'lease_expires < ? AND attempts >= ?', (now, MAX_ATTEMPTS))
+    row = conn.execute('SELECT id, target, strong, weak, items, graph '
+                       'FROM cells WHERE status = \'pending\' '
+                       'OR (status = \'leased\' AND lease_expires < ?) '
+                       'ORDER BY id LIMIT 1', (now,)).fetchone()
+    if row is not None:
+        conn.execute('UPDATE cells SET status = \'leased\', worker = ?, '
+                     'lease_expires = ?, attempts = attempts + 1 '
+                     'WHERE id = ?', (worker, now + LEASE_SECONDS, row[0]))
+    conn.execute('COMMIT')
+    return row
+
+
+def renew(db, worker, cell_id, stop):
+    # Keep the lease on a running cell alive until the cell is committed
+    conn = connect(db)
+    while not stop.wait(LEASE_SECONDS / 3):
+        conn.execute('UPDATE cells SET lease_expires = ? WHERE id = ? AND '
+                     'worker = ? AND status = \'leased\'',
+                     (time.time() + LEASE_SECONDS, cell_id, worker))
+    conn.close()
+
+
+def commit(conn, worker, cell_id, result):
+    # Record the result of a cell. If the lease was lost and another worker
+    # finished the cell first, its result is kept.
+    conn.execute('BEGIN IMMEDIATE')
+    conn.execute('UPDATE cells SET status = \'done\', worker = ?, '
+                 'iteration = ?, clicked = ?, seen = ?, condition = ? '
+                 'WHERE id = ? AND status != \'done\'',
+                 (worker,) + tuple(result) + (cell_id,))
+    conn.execute('COMMIT')
+
+
+def fail(conn, worker, cell_id, error):
+    # Record that a cell raised an error, so it is not handed out again.
+    # The error is kept in the condition column.
+    conn.execute('BEGIN IMMEDIATE')
+    conn.execute('UPDATE cells SET status = \'failed\', worker = ?, '
+                 'condition = ? WHERE id = ? AND status = \'leased\'',
+                 (worker, error, cell_id))
+    conn.execute('COMMIT')
+
+
+def work(db, worker=None):
+    # Claim, execute and commit cells until none are left
+    if worker is None:
+        worker = socket.gethostname() + ':' + str(os.getpid())
+
+    conn = connect(db)
+    config = read_config(conn)
+    configured = None
+    completed = 0
+    failed = 0
+
+    while True:
+        row = claim(conn, worker)
+        if row is None:
+            break
+        cell_id, target, strong, weak, items, graph = row
+
+        if target != configured:
+            configure(config, target)
+            configured = target
+
+        # Each cell has its own seed so results do not depend on which
+        # worker ran it, or in what order. With common random numbers the
+        # graph is the replicate whose draws are used instead.
+        np.random.seed(config['seed'] + cell_id)
+        if config['common_random_numbers']:
+            replicate = graph
+        else:
+            replicate = None
+
+        stop = threading.Event()
+        heartbeat = threading.Thread(target=renew,
+                                     args=(db, worker, cell_id, stop),
+                                     daemon=True)
+        heartbeat.start()
+        try:
+            result = network.graph_test(items, config['threshold'],
+                                        [strong, weak],
+                                        network.graph_filename(graph),
+                                        replicate=replicate)
+        except Exception:
+            # Mark the cell failed and move on to the next one
+            error = traceback.format_exc()
+            print('Cell', cell_id, 'failed:', error)
+            fail(conn, worker, cell_id, error)
+            failed += 1
+            continue
+        finally:
+            stop.set()
+            heartbeat.join()
+
+        commit(conn, worker, cell_id, (int(result[0]), int(result[1]),
+                                       int(result[2]), result[3]))
+        completed += 1
+
+    conn.close()
+    print('Worker', worker, 'completed', completed, 'cells,', failed,
+          'failed')
+
+
+def progress(conn):
+    # Count cells by status
+    counts = {'pending': 0, 'leased': 0, 'done': 0, 'failed': 0}
+    for status, count in conn.execute('SELECT status, COUNT(*) FROM cells '
+                                      'GROUP BY status'):
+        counts[status] = count
+
+    return counts
+
+
+def collect(db):
+    # Write the output files in the same format as run_graph_simulation once
+    # every cell of the sweep has been committed
+    conn = connect(db)
+    config = read_config(conn)
+    counts = progress(conn)
+    if counts['pending'] or counts['leased']:
+        print('Sweep incomplete:', counts)
+        conn.close()
+        return False
+    if counts['failed']:
+        # Output files would be missing runs, so report the failed cells
+        # rather than writing them
+        print('Sweep has failed cells:', counts)
+        for row in conn.execute('SELECT id, target, strong, weak, items, '
+                                'graph, condition FROM cells '
+                                'WHERE status = \'failed\''):
+            print(row)
+        conn.close()
+        return False
+
+    # Every cell of the configured grid must have been run
+    done = set(conn.execute('SELECT target, strong, weak, items, graph '
+                            'FROM cells WHERE status = \'done\''))
+    missing = [cell for cell in build_cells(config) if cell not in done]
+    if missing:
+        print('Sweep is missing', len(missing), 'cells of its grid:')
+        for cell in missing:
+            print(cell)
+        conn.close()
+        return False
+
+    seeds = config['seeds']
+    for target in config['targets']:
+        configure(config, target)
+        for ad_serve in config['possible_compositions']:
+            filename = network.output_filename(ad_serve)
+            network.write_header_information(ad_serve, filename)
+
+            for items in range(seeds[0], seeds[1], seeds[2]):
+                rows = conn.execute('SELECT iteration, clicked, seen, '
+                                    'condition FROM cells WHERE target = ? '
+                                    'AND strong = ? AND weak = ? AND '
+                                    'items = ? ORDER BY graph',
+                                    (target, ad_serve[0], ad_serve[1],
+                                     items)).fetchall()
+                data = network.summarise_runs(*zip(*rows))
+                with open(filename, 'a') as file:
+                    file.write('\t' + str(items) + ': ' + str(data) + '\n')
+
+            network.write_footer_information(filename)
+
+    conn.close()
+    return True
+
+
+def run_local(db, config, create_run, n_workers):
+    # Run a whole sweep on this machine with several worker processes
+    # sharing the task store, as separate hosts would
+    coordinate(db, config, create_run)
+
+    workers = [multiprocessing.Process(target=work, args=(db,))
+               for i in range(n_workers)]
+    for process in workers:
+        process.start()
+    for process in workers:
+        process.join()
+
+    collect(db)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('mode', choices=['coordinate', 'work', 'collect',
+                                         'local'])
+    parser.add_argument('--db', default='./sweep.sqlite')
+    parser.add_argument('--workers', type=int, default=4)
+    args = parser.parse_args()
+
+    # Sweep parameters, equivalent to those in network.main()
+    config = {
+        'influencers': False,
+        'pref_attachment': False,
+        'common_random_numbers': False,
+        'strength_processes': None,
+        'strength_metrics': ['strength'],
+        'strength_metric': 'strength',
+        'strength_sketch': None,
+        # One target per graph size, only used for preferential attachment
+        'targets': ['./simulation_networks/pa_parsed_10000.edgelist'],
+        'edges_to_add': 20,
+        'number_of_graphs': 20,
+        'threshold': 0.5,
+        'possible_compositions': [
+            [40, 0], [36, 4], [32, 8], [28, 12], [24, 16], [20, 20],
+            [16, 24], [30, 0], [27, 3], [24, 6], [21, 9], [18, 12],
+            [15, 15], [12, 18], [20, 0], [18, 2], [16, 4], [14, 6],
+            [12, 8], [10, 10], [8, 12], [10, 0], [9, 1], [8, 2], [7, 3],
+            [6, 4], [5, 5], [4, 6]
+        ],
+        'seeds': [10, 42, 2],
+        'seed': 123
+    }
+    create_run = 'create'
+
+    if args.mode == 'coordinate':
+        coordinate(args.db, config, create_run)
+    elif args.mode == 'work':
+        work(args.db)
+    elif args.mode == 'collect':
+        collect(args.db)
+    else:
+        run_local(args.db, config, create_run, args.workers)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,226 @@
+import os
+import tempfile
+import time
+
+import networkx as nx
+import numpy as np
+from scipy import stats
+
+import cascade
+import compact
+import degree_stats
+import network
+import partitioned
+import strength
+
+
+# Significance level of a whole validation, split evenly between its tests
+ALPHA = 0.01
+
+# Outputs of a cascade compared between engines, in the order engines
+# return them (followed by the stopping condition)
+STATISTICS = ['iterations', 'clicks', 'views']
+
+
+def reference_engine(filename, composition, items, threshold, limit, seeds):
+    # Run graph_test once per seed, seeding the global random stream as
+    # run_graph_simulation does
+    network.limit = limit
+    runs = []
+    for seed in seeds:
+        np.random.seed(seed)
+        runs.append(network.graph_test(items, threshold, composition,
+                                       filename))
+
+    return runs
+
+
+def cascade_engine(filename, composition, items, threshold, limit, seeds):
+    # Run the array engine of cascade.py once per seed
+    graph = cascade.read_arrays(filename)
+    return [cascade.run_campaigns(graph, [composition], [items], threshold,
+                                  limit, seed=seed)[0] for seed in seeds]
+
+
+def compact_engine(filename, composition, items, threshold, limit, seeds):
+    # Run the array engine on the compact (8-bit strength) representation
+    graph = compact.read_compact(filename)
+    level = compact.compact_threshold(graph, threshold)
+    return [cascade.run_campaigns(graph, [composition], [items], level,
+                                  limit, seed=seed)[0] for seed in seeds]
+
+
+def partitioned_engine(filename, composition, items, threshold, limit,
+                       seeds, processes=2):
+    # Run the partitioned engine of partitioned.py once per seed, with the
+    # graph split between the given number of shard processes
+    engine = partitioned.start_shards(cascade.read_arrays(filename),
+                                      threshold, processes)
+    try:
+        return [partitioned.run_cascade(engine, composition, items, limit,
+                                        seed) for seed in seeds]
+    finally:
+        partitioned.stop_shards(engine)
+
+
+# Engines that can be validated. Each takes a parsed graph, an Ad-Serve
+# composition, a number of starting items, the strong / weak threshold, the
+# views limit and a list of seeds, and returns (iteration, clicked, seen,
+# condition) for the cascade run with each seed.
+ENGINES = {
+    'graph_test': reference_engine,
+    'cascade': cascade_engine,
+    'compact': compact_engine,
+    'partitioned': partitioned_engine
+}
+
+
+def synthetic_graph(filename, kind, n, mean_probability=0.2, seed=123):
+    # Write a small parsed graph (strengths and probabilities) for fast
+    # validation: 'pa' for preferential attachment, 'random' for a uniform
+    # random graph or 'small_world' for a Watts-Strogatz graph. Probabilities
+    # are exponential as in assign_probabilities, with a higher mean so that
+    # cascades on small graphs often reach the views limit rather than all
+    # dying out within a few iterations.
+    if kind == 'pa':
+        edges = degree_stats.pa_edges(n, 3, seed).tolist()
+    elif kind == 'random':
+        edges = nx.gnm_random_graph(n, 3 * n, seed=seed).edges()
+    else:
+        edges = nx.watts_strogatz_graph(n, 6, 0.1, seed=seed).edges()
+
+    F = nx.Graph()
+    F.add_nodes_from(range(n))
+    F.add_edges_from(edges)
+    nx.set_edge_attributes(F, 'strength',
+                           strength.sharded_strengths(F, 1)['strength'])
+
+    rs = np.random.RandomState(seed)
+    for node in F.nodes():
+        F.node[node]['probability'] = rs.exponential(mean_probability)
+
+    network.write_graph(F, filename)
+
+
+def graph_limit(filename):
+    # Views upper limit of a parsed graph, as set_limit chooses it for
+    # preferential attachment graphs
+    with open(filename, 'r') as file:
+        n = sum(line.split(' ')[1] == 'probability' for line in file)
+
+    return 4000 if n == 4039 else int(n * 0.975)
+
+
+def validation_cases(filenames, compositions, seed_counts, threshold=0.5):
+    # Every (graph, composition, seed count) cell to validate
+    return [{'filename': filename, 'composition': composition,
+             'items': items, 'threshold': threshold,
+             'limit': graph_limit(filename)}
+            for filename in filenames
+            for composition in compositions
+            for items in seed_counts]
+
+
+def compare_samples(reference, candidate):
+    # Two-sample tests of the runs of two engines: Kolmogorov-Smirnov for
+    # each of the STATISTICS, and a chi-square test of independence for the
+    # stopping conditions. Returns the p-value of each.
+    p_values = {}
+    for i, key in enumerate(STATISTICS):
+        p_values[key] = float(stats.ks_2samp([run[i] for run in reference],
+                                             [run[i] for run in candidate])
+                              .pvalue)
+
+    conditions = sorted(set(run[3] for run in reference + candidate))
+    if len(conditions) == 1:
+        p_values['condition'] = 1.0
+    else:
+        table = [[sum(run[3] == condition for run in runs)
+                  for condition in conditions]
+                 for runs in [reference, candidate]]
+        p_values['condition'] = float(stats.chi2_contingency(table)[1])
+
+    return p_values
+
+
+def validate(candidate, cases, n_replicates=200, seed=123, alpha=ALPHA,
+             reference='graph_test'):
+    # Run the reference and candidate engines over n_replicates seeds for
+    # every case and test whether their outputs come from the same
+    # distributions. The two engines use disjoint seeds, so the tests also
+    # hold for engines that use random numbers differently. Each test is run
+    # at alpha divided by the number of tests (Bonferroni), so a correct
+    # engine fails the whole validation with probability at most alpha.
+    level = alpha / (len(cases) * (len(STATISTICS) + 1))
+    reference_total = 0
+    candidate_total = 0
+    results = []
+
+    for i, case in enumerate(cases):
+        first = seed + 2 * i * n_replicates
+        args = (case['filename'], case['composition'], case['items'],
+                case['threshold'], case['limit'])
+
+        start = time.time()
+        reference_runs = ENGINES[reference](
+            *args, seeds=list(range(first, first + n_replicates)))
+        reference_seconds = time.time() - start
+
+        start = time.time()
+        candidate_runs = ENGINES[candidate](
+            *args, seeds=list(range(first + n_replicates,
+                                    first + 2 * n_replicates)))
+        candidate_seconds = time.time() - start
+
+        p_values = compare_samples(reference_runs, candidate_runs)
+        reference_total += reference_seconds
+        candidate_total += candidate_seconds
+        results.append({
+            'case': case,
+            'p_values': p_values,
+            'passed': all(p >= level for p in p_values.values()),
+            'reference_means': np.mean([run[:3] for run in reference_runs],
+                                       axis=0).tolist(),
+            'candidate_means': np.mean([run[:3] for run in candidate_runs],
+                                       axis=0).tolist(),
+            'speedup': reference_seconds / candidate_seconds
+        })
+
+    return {'candidate': candidate, 'reference': reference,
+            'passed': all(result['passed'] for result in results),
+            'level': level, 'speedup': reference_total / candidate_total,
+            'cases': results}
+
+
+def configure():
+    # Set the module level parameters of network.py that graph_test uses
+    network.influencers = False
+    network.common_random_numbers = False
+    network.strength_metric = 'strength'
+
+
+def main():
+    configure()
+    directory = tempfile.mkdtemp()
+    filenames = []
+    for kind in ['pa', 'random', 'small_world']:
+        filename = os.path.join(directory, kind + '.edgelist')
+        synthetic_graph(filename, kind, 300)
+        filenames.append(filename)
+
+    cases = validation_cases(filenames, [[6, 0], [3, 3], [1, 5]], [2, 6])
+    for candidate in ['cascade', 'compact', 'partitioned']:
+        report = validate(candidate, cases)
+        print(candidate, 'passed' if report['passed'] else 'FAILED',
+              'speedup', round(report['speedup'], 1))
+        for result in report['cases']:
+            case = result['case']
+            print('\t' + os.path.basename(case['filename']),
+                  case['composition'], case['items'],
+                  'passed' if result['passed'] else 'FAILED',
+                  {key: round(p, 3) for key, p in
+                   result['p_values'].items()})
+
+
+if __name__ == '__main__':
+    main()